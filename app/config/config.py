@@ -45,6 +45,7 @@ whisper = _cfg.get("whisper", {})
 proxy = _cfg.get("proxy", {})
 azure = _cfg.get("azure", {})
 ui = _cfg.get("ui", {})
+http = _cfg.get("http", {})
 
 hostname = socket.gethostname()
 
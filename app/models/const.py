@@ -23,3 +23,9 @@ TASK_STATE_PROCESSING = 4
 
 FILE_TYPE_VIDEOS = ["mp4", "mov", "mkv", "webm"]
 FILE_TYPE_IMAGES = ["jpg", "jpeg", "png", "bmp"]
+
+RENDER_BACKEND_MOVIEPY = "moviepy"
+RENDER_BACKEND_FFMPEG = "ffmpeg"
+
+SUBTITLE_RENDERER_PILLOW = "pillow"
+SUBTITLE_RENDERER_LIBASS = "libass"
@@ -44,6 +44,19 @@ class MaterialInfo:
     duration: int = 0
 
 
+@pydantic.dataclasses.dataclass(config=_Config)
+class ClipSpan:
+    path: str = ""
+    start: float = 0.0
+    end: float = 0.0
+    # the url the file of path was downloaded from
+    url: str = ""
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
 # VoiceNames = [
 #     # zh-CN
 #     "female-zh-CN-XiaoxiaoNeural",
@@ -129,6 +142,8 @@ class VideoParams(BaseModel):
     stroke_width: float = 1.5
     n_threads: Optional[int] = 2
     paragraph_number: Optional[int] = 1
+    render_backend: Optional[str] = "moviepy"  # moviepy, ffmpeg
+    subtitle_renderer: Optional[str] = "pillow"  # pillow, libass
 
 
 class SubtitleRequest(BaseModel):
@@ -0,0 +1,84 @@
+import re
+
+from loguru import logger
+
+from app.config import config
+from app.services import ffmpeg
+
+_TIME_PATTERN = re.compile(r"time=(\d+):(\d+):(\d+(?:\.\d+)?)")
+_LOUDNESS_PATTERN = re.compile(r"I:\s+(-?\d+(?:\.\d+)?) LUFS")
+_SILENCE_START_PATTERN = re.compile(r"silence_start: (-?\d+(?:\.\d+)?)")
+_SILENCE_END_PATTERN = re.compile(r"silence_end: (\d+(?:\.\d+)?)")
+
+
+def _parse_duration(stderr: str) -> float:
+    # the last progress line is written once the whole file is decoded
+    matches = _TIME_PATTERN.findall(stderr)
+    if not matches:
+        return 0.0
+    hours, minutes, seconds = matches[-1]
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def _parse_silences(stderr: str, duration: float) -> list:
+    silences = []
+    start = None
+    for line in stderr.splitlines():
+        match = _SILENCE_START_PATTERN.search(line)
+        if match:
+            start = max(float(match.group(1)), 0.0)
+            continue
+        match = _SILENCE_END_PATTERN.search(line)
+        if match and start is not None:
+            silences.append([round(start, 3), round(float(match.group(1)), 3)])
+            start = None
+    if start is not None and duration > start:
+        # silence until the end of the file
+        silences.append([round(start, 3), round(duration, 3)])
+    return silences
+
+
+def analyze(audio_file: str) -> dict:
+    """
+    decode the audio once and measure its exact duration (seconds), its
+    integrated loudness (LUFS, None when too short to measure) and its
+    silences ([start, end] in seconds).
+    """
+    noise = config.app.get("silence_threshold_db", -35)
+    min_silence = config.app.get("silence_min_duration", 0.3)
+    stderr = ffmpeg.run(
+        [
+            "-nostdin",
+            "-i",
+            audio_file,
+            "-vn",
+            "-af",
+            f"ebur128=peak=none,silencedetect=noise={noise}dB:d={min_silence}",
+            "-f",
+            "null",
+            "-",
+        ]
+    )
+
+    duration = _parse_duration(stderr)
+    if duration <= 0:
+        duration = ffmpeg.probe(audio_file).get("duration", 0)
+
+    # the summary comes last, the per frame lines also contain "I:"
+    loudness = None
+    matches = _LOUDNESS_PATTERN.findall(stderr[stderr.rfind("Summary:") :])
+    if matches:
+        loudness = float(matches[0])
+        if loudness <= -70:
+            loudness = None
+
+    analysis = {
+        "duration": round(duration, 3),
+        "loudness": loudness,
+        "silences": _parse_silences(stderr, duration),
+    }
+    logger.info(
+        f"audio duration: {analysis['duration']} seconds, loudness: {loudness} LUFS, "
+        f"silences: {len(analysis['silences'])}"
+    )
+    return analysis
@@ -0,0 +1,258 @@
+import glob
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import List, Set
+
+from loguru import logger
+
+from app.config import config
+from app.models.schema import ClipSpan, VideoAspect
+from app.services import ffmpeg
+from app.utils import utils
+
+_FPS = 30
+_lock = threading.Lock()
+# entry directories in use by renders, by number of renders
+_pins = {}
+
+
+def is_enabled() -> bool:
+    return bool(config.app.get("enable_clip_cache", False))
+
+
+def cache_dir() -> str:
+    return utils.storage_dir("cache_videos/normalized", create=True)
+
+
+def _max_size() -> int:
+    return int(config.app.get("clip_cache_max_size_mb", 4096)) * 1024 * 1024
+
+
+def _entry_key(video_path: str, video_aspect: VideoAspect, max_clip_duration: int):
+    stat = os.stat(video_path)
+    source_hash = utils.md5(
+        f"{os.path.abspath(video_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+    )
+    video_width, video_height = VideoAspect(video_aspect).to_resolution()
+    return f"{source_hash}-{video_width}x{video_height}-{_FPS}-{max_clip_duration}"
+
+
+def _list_segments(entry_dir: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(entry_dir, "segment-*.mp4")))
+
+
+def _dir_size(d: str) -> int:
+    size = 0
+    for f in os.listdir(d):
+        try:
+            size += os.path.getsize(os.path.join(d, f))
+        except OSError:
+            pass
+    return size
+
+
+def _pin(entry_dir: str, pins: Set[str]):
+    # called with _lock held
+    if pins is None or entry_dir in pins:
+        return
+    pins.add(entry_dir)
+    _pins[entry_dir] = _pins.get(entry_dir, 0) + 1
+
+
+@contextmanager
+def pinned():
+    """
+    yield a set collecting the entries handed out with it (pins=), they are
+    not evicted until the block exits
+    """
+    pins = set()
+    try:
+        yield pins
+    finally:
+        with _lock:
+            for entry_dir in pins:
+                _pins[entry_dir] -= 1
+                if not _pins[entry_dir]:
+                    del _pins[entry_dir]
+
+
+def _evict():
+    """
+    remove the least recently used entries until the cache fits in its size
+    cap, entries pinned by a render are kept
+    """
+    root = cache_dir()
+    entries = []
+    total_size = 0
+    for name in os.listdir(root):
+        entry_dir = os.path.join(root, name)
+        if not os.path.isdir(entry_dir) or name.startswith("tmp-"):
+            continue
+        size = _dir_size(entry_dir)
+        total_size += size
+        if entry_dir not in _pins:
+            entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+
+    max_size = _max_size()
+    if total_size <= max_size:
+        return
+
+    entries.sort()
+    for _, size, entry_dir in entries:
+        if total_size <= max_size:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+        logger.info(f"evicted normalized clips: {entry_dir}")
+
+
+def _normalize(
+    video_path: str, entry_dir: str, video_aspect: VideoAspect, max_clip_duration: int
+):
+    video_width, video_height = VideoAspect(video_aspect).to_resolution()
+    tmp_dir = os.path.join(cache_dir(), f"tmp-{utils.get_uuid(True)}")
+    os.makedirs(tmp_dir)
+    try:
+        ffmpeg.run(
+            [
+                "-loglevel",
+                "error",
+                "-i",
+                video_path,
+                "-an",
+                "-vf",
+                f"fps={_FPS},"
+                f"scale={video_width}:{video_height}:force_original_aspect_ratio=decrease,"
+                f"pad={video_width}:{video_height}:(ow-iw)/2:(oh-ih)/2:color=black,"
+                f"setsar=1,format=yuv420p",
+                "-c:v",
+                "libx264",
+                "-preset",
+                "medium",
+                # without b-frames a copied cut ends on the requested frame
+                "-bf",
+                "0",
+                # start every segment with a keyframe so they can be stream copied
+                "-force_key_frames",
+                f"expr:gte(t,n_forced*{max_clip_duration})",
+                "-f",
+                "segment",
+                "-segment_time",
+                str(max_clip_duration),
+                # forced keyframes may land a fraction of a frame early
+                "-segment_time_delta",
+                "0.05",
+                "-reset_timestamps",
+                "1",
+                os.path.join(tmp_dir, "segment-%04d.mp4"),
+            ]
+        )
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another task normalized the same video in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def get_segments(
+    video_path: str,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    max_clip_duration: int = 5,
+    pins: Set[str] = None,
+) -> List[str]:
+    """
+    return the video scaled/padded to the target aspect at 30 fps, split into
+    clips of max_clip_duration seconds, transcoding it on the first request.
+    pins: set from pinned(), keeps the clips until the render is done
+    """
+    entry_dir = os.path.join(
+        cache_dir(), _entry_key(video_path, video_aspect, max_clip_duration)
+    )
+    with _lock:
+        segments = _list_segments(entry_dir)
+        if segments:
+            # mark as recently used
+            os.utime(entry_dir)
+            _pin(entry_dir, pins)
+    if segments:
+        logger.debug(f"normalized clips found: {entry_dir}")
+        return segments
+
+    logger.info(f"normalizing video: {video_path} => {entry_dir}")
+    _normalize(video_path, entry_dir, video_aspect, max_clip_duration)
+
+    with _lock:
+        _pin(entry_dir, pins)
+        _evict()
+        return _list_segments(entry_dir)
+
+
+def normalize_videos(
+    video_paths: List[str],
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    max_clip_duration: int = 5,
+    first_only: bool = False,
+    pins: Set[str] = None,
+) -> List[str]:
+    """
+    replace each video by its normalized clips, videos that fail to normalize
+    are kept as they are
+    """
+    results = []
+    for video_path in video_paths:
+        try:
+            segments = get_segments(video_path, video_aspect, max_clip_duration, pins)
+        except Exception as e:
+            logger.warning(f"failed to normalize video: {video_path} => {str(e)}")
+            segments = []
+
+        if not segments:
+            results.append(video_path)
+            continue
+        if first_only:
+            segments = segments[:1]
+        results.extend(segments)
+    return results
+
+
+def map_spans(
+    spans: List[ClipSpan],
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    max_clip_duration: int = 5,
+    pins: Set[str] = None,
+) -> List[ClipSpan]:
+    """
+    point planned spans (cut every max_clip_duration seconds from the start
+    of their video) to the matching normalized clips, spans of videos that
+    fail to normalize are kept as they are
+    """
+    segments = {}
+    mapped = []
+    for span in spans:
+        if span.path not in segments:
+            try:
+                segments[span.path] = get_segments(
+                    span.path, video_aspect, max_clip_duration, pins
+                )
+            except Exception as e:
+                logger.warning(f"failed to normalize video: {span.path} => {str(e)}")
+                segments[span.path] = []
+
+        index = int(span.start // max_clip_duration)
+        if index >= len(segments[span.path]):
+            mapped.append(span)
+            continue
+        offset = index * max_clip_duration
+        mapped.append(
+            ClipSpan(
+                path=segments[span.path][index],
+                start=span.start - offset,
+                end=span.end - offset,
+            )
+        )
+    return mapped
@@ -0,0 +1,128 @@
+import threading
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+from loguru import logger
+from moviepy.editor import VideoClip, VideoFileClip
+from PIL import Image
+
+from app.config import config
+from app.models.schema import ClipSpan
+from app.services import ffmpeg
+
+
+class ReaderPool:
+    """
+    the VideoFileClip readers (one ffmpeg process each) of a timeline, opened
+    when the frames of a span are first needed and closed after the last span
+    using them. at most max_open readers are open at a time, the least
+    recently used one is closed to open another.
+    """
+
+    def __init__(self, spans: List[ClipSpan], max_open: int = 0):
+        if not max_open:
+            max_open = config.app.get("max_open_readers", 4)
+        self._max_open = max(1, max_open)
+        self._readers = OrderedDict()
+        self._lock = threading.Lock()
+        self._current = -1
+        self._last_use = {}
+        for index, span in enumerate(spans):
+            self._last_use[span.path] = index
+        self.opened = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _close_reader(self, path: str):
+        reader = self._readers.pop(path, None)
+        if reader is not None:
+            reader.close()
+
+    def get(self, path: str, index: int) -> VideoFileClip:
+        """
+        the reader of path for the span at index of the timeline
+        """
+        with self._lock:
+            if index > self._current:
+                # frames are requested in timeline order, readers of the
+                # sources no later span uses are closed
+                self._current = index
+                for done in [p for p in self._readers if self._last_use[p] < index]:
+                    self._close_reader(done)
+
+            reader = self._readers.get(path)
+            if reader is not None:
+                self._readers.move_to_end(path)
+                return reader
+
+            while len(self._readers) >= self._max_open:
+                self._close_reader(next(iter(self._readers)))
+            reader = VideoFileClip(path, audio=False)
+            self._readers[path] = reader
+            self.opened += 1
+            return reader
+
+    def clip(
+        self, span: ClipSpan, index: int, video_width: int, video_height: int
+    ) -> VideoClip:
+        """
+        a clip of the span, scaled to the video size, that opens its reader on
+        the first frame. the size of the source is read with ffprobe.
+        """
+        info = ffmpeg.probe(span.path)
+        clip_w, clip_h = info["width"], info["height"]
+        if clip_w != video_width or clip_h != video_height:
+            logger.info(
+                f"resizing video to {video_width} x {video_height}, clip size: {clip_w} x {clip_h}"
+            )
+
+        def make_frame(t):
+            frame = self.get(span.path, index).get_frame(span.start + t)
+            return fit_frame(frame, video_width, video_height)
+
+        # moviepy reads the first frame of clips built with a make_frame (or
+        # resized by it) to get their size, which would open every reader
+        clip = VideoClip(duration=span.end - span.start)
+        clip.make_frame = make_frame
+        clip.size = (video_width, video_height)
+        return clip
+
+    def close(self):
+        with self._lock:
+            for path in list(self._readers):
+                self._close_reader(path)
+        logger.debug(f"reader pool closed, {self.opened} readers opened")
+
+
+def fit_frame(frame: np.ndarray, video_width: int, video_height: int) -> np.ndarray:
+    """
+    scale the frame to fit the video size keeping its aspect ratio, centered
+    on a black background, like video._resize_clip
+    """
+    clip_h, clip_w = frame.shape[:2]
+    if clip_w == video_width and clip_h == video_height:
+        return frame
+
+    if clip_w / clip_h == video_width / video_height:
+        return np.asarray(
+            Image.fromarray(frame).resize((video_width, video_height), Image.LANCZOS)
+        )
+
+    if clip_w / clip_h > video_width / video_height:
+        scale_factor = video_width / clip_w
+    else:
+        scale_factor = video_height / clip_h
+    new_width = int(clip_w * scale_factor)
+    new_height = int(clip_h * scale_factor)
+    resized = Image.fromarray(frame).resize((new_width, new_height), Image.LANCZOS)
+
+    background = np.zeros((video_height, video_width, 3), dtype=np.uint8)
+    x = (video_width - new_width) // 2
+    y = (video_height - new_height) // 2
+    background[y : y + new_height, x : x + new_width] = np.asarray(resized)
+    return background
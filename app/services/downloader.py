@@ -0,0 +1,173 @@
+import os
+import time
+
+from loguru import logger
+
+from app.config import config
+from app.services import ffmpeg, http_client, mp4
+from app.utils import utils
+
+_CHUNK_SIZE = 64 * 1024
+# the first request of a partial download, enough for the moov box of most
+# stock clips
+_HEAD_SIZE = 64 * 1024
+# partial downloads fetch a little more than needed, frames are cut on
+# packet boundaries
+_HEAD_MARGIN = 1.0
+
+# one download per target file at a time, tasks may share the cache directory
+_locks = utils.KeyLocks()
+
+
+def _file_lock(file_path: str):
+    return _locks.hold(file_path)
+
+
+def _fetch(url: str, part_path: str, timeout, end: int = 0) -> None:
+    """
+    stream the url into part_path, continuing from its current size when
+    the server supports range requests. when end is set only the bytes
+    before end are fetched.
+    """
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    if end:
+        if offset >= end:
+            return
+        headers = {"Range": f"bytes={offset}-{end - 1}"}
+    with http_client.get(url, headers=headers, timeout=timeout, stream=True) as r:
+        if r.status_code == 416:
+            # the part file is already complete
+            return
+        r.raise_for_status()
+        if end and r.status_code != 206:
+            raise IOError(f"range requests not supported: {url}")
+        if offset and r.status_code != 206:
+            logger.debug(f"range not supported, restarting download: {url}")
+            offset = 0
+
+        expected_size = None
+        if "Content-Length" in r.headers:
+            expected_size = offset + int(r.headers["Content-Length"])
+
+        with open(part_path, "ab" if offset else "wb") as f:
+            for chunk in r.iter_content(chunk_size=_CHUNK_SIZE):
+                if chunk:
+                    f.write(chunk)
+
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size < expected_size:
+        raise IOError(f"incomplete download: {size}/{expected_size} bytes")
+
+
+def download(url: str, file_path: str, timeout=(60, 240), retries: int = 0) -> str:
+    """
+    download url to file_path without buffering it in memory.
+
+    data is streamed into file_path.part, a failed attempt is resumed with a
+    range request, and the file is renamed into place once complete, so
+    file_path never holds a partial download.
+    """
+    if not retries:
+        retries = config.app.get("download_retries", 3)
+    part_path = f"{file_path}.part"
+
+    with _file_lock(file_path):
+        if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+            return file_path
+
+        for attempt in range(1, retries + 1):
+            try:
+                _fetch(url, part_path, timeout)
+                os.replace(part_path, file_path)
+                return file_path
+            except Exception as e:
+                if attempt >= retries:
+                    raise
+                logger.warning(
+                    f"download failed, attempt {attempt}/{retries}: {url} => {str(e)}"
+                )
+                time.sleep(min(2**attempt, 10))
+    return file_path
+
+
+def _get_range(url: str, start: int, end: int, timeout):
+    """
+    bytes start..end-1 of url and the size of the whole file (0 if unknown)
+    """
+    headers = {"Range": f"bytes={start}-{end - 1}"}
+    with http_client.get(url, headers=headers, timeout=timeout, stream=True) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise IOError(f"range requests not supported: {url}")
+        # Content-Range: bytes 0-262143/6720244
+        total = r.headers.get("Content-Range", "").rpartition("/")[2]
+        return r.content, int(total) if total.isdigit() else 0
+
+
+def download_head(
+    url: str, file_path: str, duration: float, timeout=(60, 240), retries: int = 0
+) -> bool:
+    """
+    download only the beginning of a faststart mp4 that plays its first
+    duration seconds, and store it as a playable video (without audio) in
+    file_path.
+
+    the moov box is read first to find where the samples of the first
+    duration seconds end, then only those bytes are fetched. return False,
+    without raising, when the file is not a faststart mp4, the server does
+    not support range requests or the saving would be small, the caller then
+    downloads the whole file.
+    """
+    if not retries:
+        retries = config.app.get("download_retries", 3)
+    part_path = f"{file_path}.head.part"
+
+    with _file_lock(file_path):
+        if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+            return True
+
+        try:
+            head, total = _get_range(url, 0, _HEAD_SIZE, timeout)
+            moov = mp4.find_moov(head)
+            if not moov:
+                logger.debug(f"not a faststart mp4, downloading all: {url}")
+                return False
+            start, end = moov
+            if end > len(head):
+                rest, _ = _get_range(url, len(head), end, timeout)
+                head += rest
+
+            size = mp4.prefix_size(head[start:end], duration + _HEAD_MARGIN)
+            if not size or (total and size > total * 0.8):
+                return False
+
+            with open(part_path, "wb") as f:
+                f.write(head[:size])
+            for attempt in range(1, retries + 1):
+                try:
+                    _fetch(url, part_path, timeout, end=size)
+                    break
+                except Exception as e:
+                    if attempt >= retries:
+                        raise
+                    logger.warning(
+                        f"download failed, attempt {attempt}/{retries}: {url} => {str(e)}"
+                    )
+                    time.sleep(min(2**attempt, 10))
+
+            trim_path = f"{file_path}.trim.mp4"
+            ffmpeg.trim(part_path, trim_path, duration)
+            os.replace(trim_path, file_path)
+            logger.info(
+                f"downloaded the first {duration} seconds, "
+                f"{size} of {total or '?'} bytes: {url}"
+            )
+            return True
+        except Exception as e:
+            logger.warning(f"partial download failed, downloading all: {url} => {e}")
+            return False
+        finally:
+            for tmp_path in (part_path, f"{file_path}.trim.mp4"):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
@@ -0,0 +1,310 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+from collections import OrderedDict
+from typing import List
+
+from loguru import logger
+
+from app.config import config
+
+# probe results by (path, size, mtime)
+_MAX_PROBE_CACHE = 4096
+_probe_cache = OrderedDict()
+_probe_lock = threading.Lock()
+
+
+def get_ffmpeg_binary() -> str:
+    # use the same binary as moviepy, it honours IMAGEIO_FFMPEG_EXE / ffmpeg_path
+    try:
+        from moviepy.config import FFMPEG_BINARY
+
+        if FFMPEG_BINARY and FFMPEG_BINARY != "unset":
+            return FFMPEG_BINARY
+    except Exception:
+        pass
+    return shutil.which("ffmpeg") or "ffmpeg"
+
+
+def get_ffprobe_binary() -> str:
+    ffprobe_path = config.app.get("ffprobe_path", "")
+    if ffprobe_path and os.path.isfile(ffprobe_path):
+        return ffprobe_path
+
+    # ffprobe is usually shipped next to ffmpeg
+    ffmpeg_binary = get_ffmpeg_binary()
+    ffmpeg_dir = os.path.dirname(ffmpeg_binary)
+    if ffmpeg_dir:
+        name = "ffprobe.exe" if os.name == "nt" else "ffprobe"
+        sibling = os.path.join(ffmpeg_dir, name)
+        if os.path.isfile(sibling):
+            return sibling
+
+    return shutil.which("ffprobe") or ""
+
+
+def run(args: List[str]) -> str:
+    """
+    run ffmpeg with the given arguments, return stderr (ffmpeg logs to stderr)
+    """
+    cmd = [get_ffmpeg_binary(), "-y", "-hide_banner", *args]
+    logger.debug(f"ffmpeg: {subprocess.list2cmdline(cmd)}")
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr = proc.stderr.decode("utf-8", errors="ignore")
+    if proc.returncode != 0:
+        tail = "\n".join(stderr.strip().splitlines()[-10:])
+        raise RuntimeError(f"ffmpeg exited with code {proc.returncode}: {tail}")
+    return stderr
+
+
+def _parse_rate(rate: str) -> float:
+    if not rate:
+        return 0.0
+    if "/" in rate:
+        num, den = rate.split("/", 1)
+        try:
+            num, den = float(num), float(den)
+        except ValueError:
+            return 0.0
+        return num / den if den else 0.0
+    try:
+        return float(rate)
+    except ValueError:
+        return 0.0
+
+
+def _probe_with_ffprobe(ffprobe_binary: str, file_path: str) -> dict:
+    cmd = [
+        ffprobe_binary,
+        "-v",
+        "error",
+        "-print_format",
+        "json",
+        "-show_format",
+        "-show_streams",
+        file_path,
+    ]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.decode("utf-8", errors="ignore").strip())
+
+    data = json.loads(proc.stdout.decode("utf-8", errors="ignore") or "{}")
+    info = {
+        "duration": float(data.get("format", {}).get("duration", 0) or 0),
+        "width": 0,
+        "height": 0,
+        "fps": 0.0,
+        "codec": "",
+        "pix_fmt": "",
+        "has_video": False,
+        "has_audio": False,
+    }
+    for stream in data.get("streams", []):
+        codec_type = stream.get("codec_type")
+        if codec_type == "video" and not info["has_video"]:
+            info["has_video"] = True
+            info["width"] = int(stream.get("width", 0) or 0)
+            info["height"] = int(stream.get("height", 0) or 0)
+            info["fps"] = _parse_rate(stream.get("avg_frame_rate", "")) or _parse_rate(
+                stream.get("r_frame_rate", "")
+            )
+            info["codec"] = stream.get("codec_name", "")
+            info["pix_fmt"] = stream.get("pix_fmt", "")
+            if not info["duration"]:
+                info["duration"] = float(stream.get("duration", 0) or 0)
+        elif codec_type == "audio":
+            info["has_audio"] = True
+    return info
+
+
+def _probe_with_ffmpeg(file_path: str) -> dict:
+    # "ffmpeg -i" exits with an error because no output is given, but the
+    # stream information is still printed to stderr
+    cmd = [get_ffmpeg_binary(), "-hide_banner", "-i", file_path]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr = proc.stderr.decode("utf-8", errors="ignore")
+
+    info = {
+        "duration": 0.0,
+        "width": 0,
+        "height": 0,
+        "fps": 0.0,
+        "codec": "",
+        "pix_fmt": "",
+        "has_video": False,
+        "has_audio": False,
+    }
+    m = re.search(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)", stderr)
+    if m:
+        hours, minutes, seconds = m.groups()
+        info["duration"] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    for line in stderr.splitlines():
+        line = line.strip()
+        if not line.startswith("Stream #"):
+            continue
+        if " Audio: " in line:
+            info["has_audio"] = True
+            continue
+        if " Video: " not in line or info["has_video"]:
+            continue
+        info["has_video"] = True
+        video_desc = line.split(" Video: ", 1)[1]
+        info["codec"] = video_desc.split(" ", 1)[0].strip(",")
+        fields = re.split(r",\s*(?![^()]*\))", video_desc)
+        if len(fields) > 1:
+            info["pix_fmt"] = fields[1].split("(")[0].strip()
+        size = re.search(r"\b(\d{2,5})x(\d{2,5})\b", video_desc)
+        if size:
+            info["width"], info["height"] = int(size.group(1)), int(size.group(2))
+        fps = re.search(r"(\d+(?:\.\d+)?)\s*fps", video_desc)
+        if fps:
+            info["fps"] = float(fps.group(1))
+    return info
+
+
+def _probe(file_path: str) -> dict:
+    ffprobe_binary = get_ffprobe_binary()
+    if ffprobe_binary:
+        try:
+            return _probe_with_ffprobe(ffprobe_binary, file_path)
+        except Exception as e:
+            logger.warning(f"ffprobe failed: {file_path} => {str(e)}")
+    return _probe_with_ffmpeg(file_path)
+
+
+def probe(file_path: str) -> dict:
+    """
+    read duration, size, fps, codec and pixel format of a media file
+    without decoding any frame, results are cached until the file changes
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _probe_lock:
+        info = _probe_cache.get(key)
+        if info is not None:
+            _probe_cache.move_to_end(key)
+            return dict(info)
+
+    info = _probe(file_path)
+    with _probe_lock:
+        _probe_cache[key] = info
+        while len(_probe_cache) > _MAX_PROBE_CACHE:
+            _probe_cache.popitem(last=False)
+    return dict(info)
+
+
+def keyframes(file_path: str) -> List[float]:
+    """
+    timestamps (seconds) of the keyframes of the first video stream, read
+    from the packet flags without decoding any frame
+    """
+    cmd = [
+        get_ffmpeg_binary(),
+        "-hide_banner",
+        "-v",
+        "error",
+        "-i",
+        file_path,
+        "-map",
+        "0:v:0",
+        "-c",
+        "copy",
+        "-f",
+        "framecrc",
+        "-",
+    ]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.decode("utf-8", errors="ignore").strip())
+
+    time_base = 0.0
+    times = []
+    for line in proc.stdout.decode("utf-8", errors="ignore").splitlines():
+        if line.startswith("#tb 0:"):
+            time_base = _parse_rate(line.split(":", 1)[1].strip())
+            continue
+        # stream, dts, pts, duration, size, crc, the flags ("F=0x0") are only
+        # written for packets that are not keyframes
+        fields = line.split(",")
+        if line.startswith("#") or len(fields) != 6:
+            continue
+        times.append(int(fields[2]) * time_base)
+    return sorted(times)
+
+
+def concat(file_paths: List[str], output_file: str, duration: float = 0) -> str:
+    """
+    join files that share codec, size, fps and pixel format with the concat
+    demuxer, packets are copied without re-encoding. when duration is set
+    the output stops after duration seconds.
+    """
+    list_file = f"{output_file}.concat.txt"
+    with open(list_file, "w", encoding="utf-8") as f:
+        for file_path in file_paths:
+            file_path = os.path.abspath(file_path).replace("\\", "/")
+            file_path = file_path.replace("'", "'\\''")
+            f.write(f"file '{file_path}'\n")
+    try:
+        run(
+            [
+                "-loglevel",
+                "error",
+                "-f",
+                "concat",
+                "-safe",
+                "0",
+                "-i",
+                list_file,
+                *(["-t", f"{duration:.3f}"] if duration > 0 else []),
+                "-c",
+                "copy",
+                "-movflags",
+                "+faststart",
+                output_file,
+            ]
+        )
+    finally:
+        try:
+            os.remove(list_file)
+        except Exception:
+            pass
+    return output_file
+
+
+def trim(input_file: str, output_file: str, duration: float) -> str:
+    """
+    keep the first duration seconds of the video stream, packets are copied
+    without re-encoding and the audio is dropped
+    """
+    run(
+        [
+            "-loglevel",
+            "error",
+            "-i",
+            input_file,
+            "-t",
+            f"{duration:.3f}",
+            "-map",
+            "0:v:0",
+            "-c",
+            "copy",
+            "-an",
+            "-movflags",
+            "+faststart",
+            output_file,
+        ]
+    )
+    return output_file
+
+
+def escape_filter_value(value: str) -> str:
+    """
+    escape a value (usually a file path) for use inside a filtergraph
+    """
+    value = value.replace("\\", "/")
+    value = value.replace(":", "\\:")
+    return f"'{value}'"
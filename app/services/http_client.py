@@ -0,0 +1,55 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from app.config import config
+
+_session = None
+_lock = threading.Lock()
+
+
+def _create_session() -> requests.Session:
+    cfg = config.http
+    retry = Retry(
+        total=cfg.get("max_retries", 3),
+        connect=cfg.get("max_retries", 3),
+        read=0,
+        backoff_factor=cfg.get("backoff_factor", 0.5),
+        status_forcelist=cfg.get("retry_status_codes", [500, 502, 503, 504]),
+        allowed_methods=["GET", "HEAD"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=cfg.get("pool_connections", 10),
+        pool_maxsize=cfg.get("pool_maxsize", 16),
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.verify = False
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    the session shared by all threads, connections are kept alive and pooled
+    per host (pool_connections hosts, pool_maxsize connections each)
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    # the environment (HTTP(S)_PROXY) overrides the proxies of the session
+    # but not those given per request
+    kwargs.setdefault("proxies", config.proxy)
+    return get_session().get(url, **kwargs)
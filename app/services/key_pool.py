@@ -0,0 +1,203 @@
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, List
+
+from loguru import logger
+
+from app.config import config
+from app.utils import utils
+
+# cooldown of a throttled key when the response does not say how long to wait
+_DEFAULT_COOLDOWN = 60
+
+
+def _new_key_state() -> dict:
+    return {
+        # requests left before the limit resets, None until a response tells
+        "remaining": None,
+        "reset_at": 0.0,
+        "cooldown_until": 0.0,
+        "last_used": 0.0,
+    }
+
+
+def _header(headers, name: str):
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _parse_reset(value, now: float) -> float:
+    """
+    pexels sends the reset time as a unix timestamp, pixabay as seconds from now
+    """
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return value if value > 1e9 else now + value
+
+
+def _choose_key(states: Dict[str, dict], now: float) -> str:
+    for s in states.values():
+        if s["reset_at"] and now >= s["reset_at"]:
+            s["remaining"], s["reset_at"] = None, 0.0
+
+    available = [
+        key
+        for key, s in states.items()
+        if s["cooldown_until"] <= now and (s["remaining"] is None or s["remaining"] > 0)
+    ]
+    if available:
+        # the key with the most requests left, the least recently used on ties,
+        # keys without known limits yet are tried first
+        return max(
+            available,
+            key=lambda k: (
+                (
+                    float("inf")
+                    if states[k]["remaining"] is None
+                    else states[k]["remaining"]
+                ),
+                -states[k]["last_used"],
+            ),
+        )
+
+    # every key is throttled, use the one that recovers first
+    def recovers_at(key):
+        s = states[key]
+        return max(s["cooldown_until"], s["reset_at"] if s["remaining"] == 0 else 0)
+
+    key = min(states, key=recovers_at)
+    logger.warning(
+        f"all api keys are rate limited, the first one recovers in "
+        f"{max(recovers_at(key) - now, 0):.0f} seconds"
+    )
+    return key
+
+
+def _update_key_state(state: dict, status_code: int, headers, now: float):
+    remaining = _header(headers, "x-ratelimit-remaining")
+    if remaining is not None:
+        try:
+            state["remaining"] = int(remaining)
+        except ValueError:
+            pass
+    reset = _header(headers, "x-ratelimit-reset")
+    if reset is not None:
+        state["reset_at"] = _parse_reset(reset, now)
+
+    if status_code == 429:
+        retry_after = _parse_reset(_header(headers, "retry-after"), now)
+        if not retry_after:
+            retry_after = state["reset_at"] or now + _DEFAULT_COOLDOWN
+        state["cooldown_until"] = max(retry_after, now + 1)
+        state["remaining"] = 0
+
+
+# Base class for api key scheduling
+class BaseKeyPool(ABC):
+    """
+    picks the api key with the most requests left, following the rate limit
+    headers of each response, keys answering 429 are put on cooldown
+    """
+
+    @abstractmethod
+    def _lock(self, name: str):
+        pass
+
+    @abstractmethod
+    def _load(self, name: str, keys: List[str]) -> Dict[str, dict]:
+        pass
+
+    @abstractmethod
+    def _save(self, name: str, key: str, state: dict):
+        pass
+
+    def acquire(self, name: str, keys: List[str]) -> str:
+        now = time.time()
+        with self._lock(name):
+            states = self._load(name, keys)
+            key = _choose_key(states, now)
+            state = states[key]
+            state["last_used"] = now
+            if state["remaining"]:
+                # spend a token now, concurrent requests spread over the keys
+                state["remaining"] -= 1
+            self._save(name, key, state)
+        return key
+
+    def report(self, name: str, key: str, status_code: int, headers):
+        now = time.time()
+        with self._lock(name):
+            state = self._load(name, [key])[key]
+            _update_key_state(state, status_code, headers, now)
+            self._save(name, key, state)
+        if status_code == 429:
+            logger.warning(
+                f"api key {key[:4]}*** of {name} is rate limited, "
+                f"cooldown {state['cooldown_until'] - now:.0f} seconds"
+            )
+
+
+# Memory key pool
+class MemoryKeyPool(BaseKeyPool):
+    def __init__(self):
+        self._states = {}
+        self._mutex = threading.Lock()
+
+    @contextmanager
+    def _lock(self, name: str):
+        with self._mutex:
+            yield
+
+    def _load(self, name: str, keys: List[str]) -> Dict[str, dict]:
+        pool = self._states.setdefault(name, {})
+        return {key: dict(pool.get(key) or _new_key_state()) for key in keys}
+
+    def _save(self, name: str, key: str, state: dict):
+        self._states.setdefault(name, {})[key] = state
+
+
+# Redis key pool, shared by all the workers using the same redis
+class RedisKeyPool(BaseKeyPool):
+    def __init__(self, host="localhost", port=6379, db=0, password=None):
+        import redis
+
+        self._redis = redis.StrictRedis(host=host, port=port, db=db, password=password)
+
+    @contextmanager
+    def _lock(self, name: str):
+        with self._redis.lock(f"key_pool:{name}:lock", timeout=10, blocking_timeout=10):
+            yield
+
+    def _load(self, name: str, keys: List[str]) -> Dict[str, dict]:
+        # the keys themselves are not stored, only their hashes
+        values = self._redis.hmget(f"key_pool:{name}", [utils.md5(k) for k in keys])
+        return {
+            key: json.loads(value) if value else _new_key_state()
+            for key, value in zip(keys, values)
+        }
+
+    def _save(self, name: str, key: str, state: dict):
+        self._redis.hset(f"key_pool:{name}", utils.md5(key), json.dumps(state))
+
+
+# Global key pool
+_enable_redis = config.app.get("enable_redis", False)
+_redis_host = config.app.get("redis_host", "localhost")
+_redis_port = config.app.get("redis_port", 6379)
+_redis_db = config.app.get("redis_db", 0)
+_redis_password = config.app.get("redis_password", None)
+
+key_pool = (
+    RedisKeyPool(
+        host=_redis_host, port=_redis_port, db=_redis_db, password=_redis_password
+    )
+    if _enable_redis
+    else MemoryKeyPool()
+)
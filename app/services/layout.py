@@ -0,0 +1,148 @@
+import bisect
+from functools import lru_cache
+from itertools import accumulate
+
+from PIL import ImageFont
+
+
+@lru_cache(maxsize=32)
+def load_font(font_path: str, font_size: int):
+    """
+    fonts are parsed once per (path, size) and shared by all tasks of the process
+    """
+    return ImageFont.truetype(font_path, font_size)
+
+
+@lru_cache(maxsize=65536)
+def _advance(font_path: str, font_size: int, char: str) -> float:
+    return load_font(font_path, font_size).getlength(char)
+
+
+def _first_overflow(is_over, lo: int, hi: int, guess: int) -> int:
+    """
+    smallest j in [lo, hi] for which is_over(j) is true, hi + 1 when there is
+    none, is_over must be monotonic, the search gallops outwards from guess
+    """
+    guess = min(max(guess, lo), hi)
+    if is_over(guess):
+        bad, good, step = lo - 1, guess, 1
+        while guess - step >= lo:
+            if not is_over(guess - step):
+                bad = guess - step
+                break
+            good = guess - step
+            step *= 2
+    else:
+        bad, good, step = guess, hi + 1, 1
+        while guess + step <= hi:
+            if is_over(guess + step):
+                good = guess + step
+                break
+            bad = guess + step
+            step *= 2
+
+    lo, hi = bad + 1, good
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if is_over(mid):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def wrap_text(text, max_width, font="Arial", fontsize=60):
+    """
+    wrap text into lines no wider than max_width, return (wrapped text, height)
+
+    lines are split on spaces, or on characters when a single word does not
+    fit (CJK text). the summed glyph advances give a first guess of where a line
+    ends, which is then confirmed by measuring the line with the font, so only
+    a few measurements are needed per line instead of one per word/character.
+    """
+    font_path = font
+    font = load_font(font_path, fontsize)
+    widths = {}
+
+    def get_text_width(inner_text):
+        inner_text = inner_text.strip()
+        width = widths.get(inner_text)
+        if width is None:
+            left, top, right, bottom = font.getbbox(inner_text)
+            width = widths[inner_text] = right - left
+        return width
+
+    left, top, right, bottom = font.getbbox(text.strip())
+    width, height = right - left, bottom - top
+    widths[text.strip()] = width
+    if width <= max_width:
+        return text, height
+
+    # advance of text[:i], used to guess where a line starting at a given
+    # character overflows
+    offsets = list(
+        accumulate((_advance(font_path, fontsize, c) for c in text), initial=0)
+    )
+
+    def guess_end(start):
+        return bisect.bisect_right(offsets, offsets[start] + max_width)
+
+    # wrap by words
+    words = text.split(" ")
+    starts, ends = [], []
+    pos = 0
+    for word in words:
+        starts.append(pos)
+        ends.append(pos + len(word))
+        pos += len(word) + 1
+
+    def line_of_words(first, last):
+        # words[first:last] followed by a space
+        return text[starts[first] : ends[last - 1]] + " "
+
+    processed = True
+    lines = []
+    first = 0
+    while True:
+        # a line started by an overflowing word is measured once the next
+        # word is added
+        lo = 1 if first == 0 else first + 2
+        if lo > len(words):
+            lines.append(line_of_words(first, len(words)))
+            break
+        guess = bisect.bisect_left(ends, guess_end(starts[first])) + 1
+        last = _first_overflow(
+            lambda j: get_text_width(line_of_words(first, j)) > max_width,
+            lo,
+            len(words),
+            guess,
+        )
+        if last > len(words):
+            lines.append(line_of_words(first, len(words)))
+            break
+        if line_of_words(first, last).strip() == words[last - 1].strip():
+            processed = False
+            break
+        lines.append(line_of_words(first, last - 1))
+        first = last - 1
+
+    if processed:
+        lines = [line.strip() for line in lines]
+        return "\n".join(lines).strip(), len(lines) * height
+
+    # wrap by characters, the overflowing character ends the line
+    lines = []
+    first = 0
+    while first < len(text):
+        last = _first_overflow(
+            lambda j: get_text_width(text[first:j]) > max_width,
+            first + 1,
+            len(text),
+            guess_end(first),
+        )
+        if last > len(text):
+            break
+        lines.append(text[first:last])
+        first = last
+    lines.append(text[first:])
+    return "\n".join(lines).strip(), len(lines) * height
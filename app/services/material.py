@@ -1,20 +1,27 @@
+import math
 import os
 import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlencode
 
-import requests
-from typing import List
+from typing import Dict, List, Set, Tuple
 from loguru import logger
-from moviepy.video.io.VideoFileClip import VideoFileClip
 
 from app.config import config
-from app.models.schema import VideoAspect, VideoConcatMode, MaterialInfo
+from app.models.schema import ClipSpan, VideoAspect, VideoConcatMode, MaterialInfo
+from app.services import (
+    downloader,
+    ffmpeg,
+    http_client,
+    material_store,
+    planner,
+    search_cache,
+)
+from app.services.key_pool import key_pool
 from app.utils import utils
 
-requested_count = 0
 
-
-def get_api_key(cfg_key: str):
+def _get_api_keys(cfg_key: str) -> List[str]:
     api_keys = config.app.get(cfg_key)
     if not api_keys:
         raise ValueError(
@@ -22,13 +29,30 @@ def get_api_key(cfg_key: str):
             f"{utils.to_json(config.app)}"
         )
 
-    # if only one key is provided, return it
     if isinstance(api_keys, str):
-        return api_keys
+        return [api_keys]
+    return list(api_keys)
+
 
-    global requested_count
-    requested_count += 1
-    return api_keys[requested_count % len(api_keys)]
+def get_api_key(cfg_key: str):
+    return key_pool.acquire(cfg_key, _get_api_keys(cfg_key))
+
+
+def _request_with_api_key(cfg_key: str, request):
+    """
+    call request(api_key) with the key that has the most requests left, the
+    rate limit headers of the response are reported back to the key pool, a
+    throttled request is retried once with another key
+    """
+    api_keys = _get_api_keys(cfg_key)
+    attempts = min(len(api_keys), 2)
+    for _ in range(attempts):
+        api_key = key_pool.acquire(cfg_key, api_keys)
+        r = request(api_key)
+        key_pool.report(cfg_key, api_key, r.status_code, r.headers)
+        if r.status_code != 429:
+            break
+    return r
 
 
 def search_videos_pexels(
@@ -39,27 +63,44 @@ def search_videos_pexels(
     aspect = VideoAspect(video_aspect)
     video_orientation = aspect.name
     video_width, video_height = aspect.to_resolution()
-    api_key = get_api_key("pexels_api_keys")
-    headers = {"Authorization": api_key}
-    # Build URL
-    params = {"query": search_term, "per_page": 5, "orientation": video_orientation}
-    query_url = f"https://api.pexels.com/videos/search?{urlencode(params)}"
-    logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
+    per_page = 5
 
     try:
-        r = requests.get(
-            query_url,
-            headers=headers,
-            proxies=config.proxy,
-            verify=False,
-            timeout=(30, 60),
-        )
-        response = r.json()
         video_items = []
-        if "videos" not in response:
-            logger.error(f"search videos failed: {response}")
-            return video_items
-        videos = response["videos"]
+        videos = search_cache.get("pexels", search_term, video_orientation, per_page)
+        if videos is None:
+
+            def request(api_key):
+                headers = {"Authorization": api_key}
+                # Build URL
+                params = {
+                    "query": search_term,
+                    "per_page": per_page,
+                    "orientation": video_orientation,
+                }
+                query_url = f"https://api.pexels.com/videos/search?{urlencode(params)}"
+                logger.info(
+                    f"searching videos: {query_url}, with proxies: {config.proxy}"
+                )
+                return http_client.get(query_url, headers=headers, timeout=(30, 60))
+
+            r = _request_with_api_key("pexels_api_keys", request)
+            response = r.json()
+            if "videos" not in response:
+                logger.error(f"search videos failed: {response}")
+                return video_items
+            # keep only the fields used below
+            videos = [
+                {
+                    "duration": v["duration"],
+                    "video_files": [
+                        {"width": f["width"], "height": f["height"], "link": f["link"]}
+                        for f in v["video_files"]
+                    ],
+                }
+                for v in response["videos"]
+            ]
+            search_cache.put("pexels", search_term, video_orientation, per_page, videos)
         # loop through each video in the result
         for v in videos:
             duration = v["duration"]
@@ -94,27 +135,49 @@ def search_videos_pixabay(
 
     video_width, video_height = aspect.to_resolution()
 
-    api_key = get_api_key("pixabay_api_keys")
-    # Build URL
-    params = {
-        "q": search_term,
-        "video_type": "all",  # Accepted values: "all", "film", "animation"
-        "per_page": 50,
-        "key": api_key,
-    }
-    query_url = f"https://pixabay.com/api/videos/?{urlencode(params)}"
-    logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
+    per_page = 50
 
     try:
-        r = requests.get(
-            query_url, proxies=config.proxy, verify=False, timeout=(30, 60)
-        )
-        response = r.json()
         video_items = []
-        if "hits" not in response:
-            logger.error(f"search videos failed: {response}")
-            return video_items
-        videos = response["hits"]
+        # the query does not depend on the aspect, results are filtered below
+        videos = search_cache.get("pixabay", search_term, "all", per_page)
+        if videos is None:
+
+            def request(api_key):
+                # Build URL
+                params = {
+                    "q": search_term,
+                    "video_type": "all",  # Accepted values: "all", "film", "animation"
+                    "per_page": per_page,
+                    "key": api_key,
+                }
+                query_url = f"https://pixabay.com/api/videos/?{urlencode(params)}"
+                logger.info(
+                    f"searching videos: {query_url}, with proxies: {config.proxy}"
+                )
+                return http_client.get(query_url, timeout=(30, 60))
+
+            r = _request_with_api_key("pixabay_api_keys", request)
+            response = r.json()
+            if "hits" not in response:
+                logger.error(f"search videos failed: {response}")
+                return video_items
+            # keep only the fields used below
+            videos = [
+                {
+                    "duration": v["duration"],
+                    "videos": {
+                        video_type: {
+                            "width": f["width"],
+                            "height": f["height"],
+                            "url": f["url"],
+                        }
+                        for video_type, f in v["videos"].items()
+                    },
+                }
+                for v in response["hits"]
+            ]
+            search_cache.put("pixabay", search_term, "all", per_page, videos)
         # loop through each video in the result
         for v in videos:
             duration = v["duration"]
@@ -141,7 +204,112 @@ def search_videos_pixabay(
     return []
 
 
-def save_video(video_url: str, save_dir: str = "") -> str:
+_search_functions = {
+    "pexels": search_videos_pexels,
+    "pixabay": search_videos_pixabay,
+}
+_search_api_keys = {
+    "pexels": "pexels_api_keys",
+    "pixabay": "pixabay_api_keys",
+}
+# footage searched for, relative to the audio duration, the spare part
+# replaces videos that fail to download
+_SEARCH_COVERAGE = 1.5
+
+
+def search_videos_parallel(
+    search_terms: List[str],
+    sources: List[str],
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    minimum_duration: int = 5,
+    required_duration: float = 0.0,
+) -> List[MaterialInfo]:
+    """
+    search every (term, provider) pair at the same time, results are merged
+    in term order and deduplicated by url.
+
+    once the usable duration (at most minimum_duration seconds per video) of
+    the finished searches covers required_duration, the remaining searches
+    are not waited for.
+    """
+    queries = [
+        (search_term, provider)
+        for search_term in search_terms
+        for provider in sources
+        if provider in _search_functions
+    ]
+    if not queries:
+        return []
+
+    max_workers = max(1, min(len(queries), config.app.get("search_workers", 8)))
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {
+        executor.submit(
+            _search_functions[provider],
+            search_term=search_term,
+            minimum_duration=minimum_duration,
+            video_aspect=video_aspect,
+        ): i
+        for i, (search_term, provider) in enumerate(queries)
+    }
+
+    results = {}
+    usable_urls = set()
+    usable_duration = 0.0
+    try:
+        for future in as_completed(futures):
+            i = futures[future]
+            search_term, provider = queries[i]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                logger.error(f"search videos failed: {search_term} => {str(e)}")
+                continue
+            logger.info(
+                f"found {len(results[i])} videos for '{search_term}' on {provider}"
+            )
+
+            for item in results[i]:
+                if item.url not in usable_urls:
+                    usable_urls.add(item.url)
+                    usable_duration += min(item.duration, minimum_duration)
+            if required_duration and usable_duration >= required_duration:
+                if len(results) < len(queries):
+                    logger.info(
+                        f"found {usable_duration} seconds of videos, "
+                        f"skip {len(queries) - len(results)} searches"
+                    )
+                break
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    valid_video_items = []
+    valid_video_urls = set()
+    for i in sorted(results):
+        for item in results[i]:
+            if item.url not in valid_video_urls:
+                valid_video_items.append(item)
+                valid_video_urls.add(item.url)
+    return valid_video_items
+
+
+def save_video(
+    video_url: str,
+    save_dir: str = "",
+    provider: str = "",
+    max_duration: float = 0,
+    pins: Set[str] = None,
+) -> str:
+    """
+    download a video into save_dir and return its path, "" when the file is
+    not a valid video.
+
+    when max_duration is set only the beginning of the video that plays the
+    first max_duration seconds is downloaded (if the server and the file
+    allow it), the saved video is then that long and has no audio.
+    pins: set from material_store.pinned(), keeps the file until the task
+    is done
+    """
     if not save_dir:
         save_dir = utils.storage_dir("cache_videos")
 
@@ -149,108 +317,306 @@ def save_video(video_url: str, save_dir: str = "") -> str:
         os.makedirs(save_dir)
 
     url_without_query = video_url.split("?")[0]
-    url_hash = utils.md5(url_without_query)
-    video_id = f"vid-{url_hash}"
-    video_path = f"{save_dir}/{video_id}.mp4"
 
     # if video already exists, return the path
-    if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
-        logger.info(f"video already exists: {video_path}")
-        return video_path
-
-    # if video does not exist, download it
-    with open(video_path, "wb") as f:
-        f.write(
-            requests.get(
-                video_url, proxies=config.proxy, verify=False, timeout=(60, 240)
-            ).content
+    info = material_store.lookup(url_without_query, save_dir, pins)
+    if info:
+        logger.info(f"video already exists: {info['path']}")
+        return info["path"]
+
+    # concurrent tasks downloading the same url share the same file names
+    with material_store.url_lock(url_without_query, save_dir):
+        return _save_video(
+            video_url, url_without_query, save_dir, provider, max_duration, pins
         )
 
-    if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
+
+def _save_video(
+    video_url: str,
+    url_without_query: str,
+    save_dir: str,
+    provider: str,
+    max_duration: float,
+    pins: Set[str],
+) -> str:
+    # another task may have stored the url while waiting for the lock
+    info = material_store.lookup(url_without_query, save_dir, pins)
+    if info:
+        logger.info(f"video already exists: {info['path']}")
+        return info["path"]
+
+    url_key = url_without_query
+    video_path = ""
+    if max_duration > 0 and config.app.get("partial_download", True):
+        # truncated files are indexed by the url and their duration
+        max_duration = math.ceil(max_duration)
+        partial_key = f"{url_without_query}#t={max_duration}"
+        info = material_store.lookup(partial_key, save_dir, pins)
+        if info:
+            logger.info(f"video already exists: {info['path']}")
+            return info["path"]
+        partial_path = f"{save_dir}/vid-{utils.md5(partial_key)}.mp4"
+        if downloader.download_head(video_url, partial_path, max_duration):
+            url_key, video_path = partial_key, partial_path
+
+    if not video_path:
+        url_hash = utils.md5(url_without_query)
+        video_id = f"vid-{url_hash}"
+        video_path = f"{save_dir}/{video_id}.mp4"
+
+        # if video does not exist, download it, files downloaded before the
+        # index existed are indexed as they are
+        if not (os.path.exists(video_path) and os.path.getsize(video_path) > 0):
+            downloader.download(video_url, video_path, timeout=(60, 240))
+
+    try:
+        info = material_store.add(url_key, provider, video_path, pins)
+        return info["path"]
+    except Exception as e:
         try:
-            clip = VideoFileClip(video_path)
-            duration = clip.duration
-            fps = clip.fps
-            clip.close()
-            if duration > 0 and fps > 0:
-                return video_path
-        except Exception as e:
-            try:
-                os.remove(video_path)
-            except Exception as e:
-                pass
-            logger.warning(f"invalid video file: {video_path} => {str(e)}")
+            os.remove(video_path)
+        except Exception:
+            pass
+        logger.warning(f"invalid video file: {video_path} => {str(e)}")
     return ""
 
 
-def download_videos(
-    task_id: str,
+def _material_directory(task_id: str) -> str:
+    material_directory = config.app.get("material_directory", "").strip()
+    if material_directory == "task":
+        material_directory = utils.task_dir(task_id)
+    elif material_directory and not os.path.isdir(material_directory):
+        material_directory = ""
+    return material_directory
+
+
+def search_materials(
     search_terms: List[str],
     source: str = "pexels",
     video_aspect: VideoAspect = VideoAspect.landscape,
     video_contact_mode: VideoConcatMode = VideoConcatMode.random,
     audio_duration: float = 0.0,
     max_clip_duration: int = 5,
-) -> List[str]:
-    valid_video_items = []
-    valid_video_urls = []
-    found_duration = 0.0
-    search_videos = search_videos_pexels
-    if source == "pixabay":
-        search_videos = search_videos_pixabay
-
-    for search_term in search_terms:
-        video_items = search_videos(
-            search_term=search_term,
-            minimum_duration=max_clip_duration,
-            video_aspect=video_aspect,
-        )
-        logger.info(f"found {len(video_items)} videos for '{search_term}'")
-
-        for item in video_items:
-            if item.url not in valid_video_urls:
-                valid_video_items.append(item)
-                valid_video_urls.append(item.url)
-                found_duration += item.duration
+) -> List[MaterialInfo]:
+    """
+    candidate videos for the search terms, in the order they should be used
+    """
+    sources = ["pixabay" if source == "pixabay" else "pexels"]
+    if config.app.get("search_all_providers", False):
+        # only search the providers an api key is configured for
+        sources += [
+            provider
+            for provider, cfg_key in _search_api_keys.items()
+            if provider not in sources and config.app.get(cfg_key)
+        ]
+
+    valid_video_items = search_videos_parallel(
+        search_terms=search_terms,
+        sources=sources,
+        video_aspect=video_aspect,
+        minimum_duration=max_clip_duration,
+        required_duration=audio_duration * _SEARCH_COVERAGE,
+    )
+    found_duration = sum(item.duration for item in valid_video_items)
 
     logger.info(
         f"found total videos: {len(valid_video_items)}, required duration: {audio_duration} seconds, found duration: {found_duration} seconds"
     )
-    video_paths = []
-
-    material_directory = config.app.get("material_directory", "").strip()
-    if material_directory == "task":
-        material_directory = utils.task_dir(task_id)
-    elif material_directory and not os.path.isdir(material_directory):
-        material_directory = ""
 
     if video_contact_mode.value == VideoConcatMode.random.value:
         random.shuffle(valid_video_items)
+    return valid_video_items
 
-    total_duration = 0.0
-    for item in valid_video_items:
-        try:
+
+def download_materials(
+    task_id: str,
+    items: List[MaterialInfo],
+    max_durations: Dict[str, float] = None,
+    pins: Set[str] = None,
+) -> Dict[str, str]:
+    """
+    download all the items concurrently, return {url: local path}, failed
+    downloads are left out. max_durations limits how many seconds of a video
+    are downloaded, by url. pins: see save_video
+    """
+    max_durations = max_durations or {}
+    material_directory = _material_directory(task_id)
+    max_workers = max(1, config.app.get("download_workers", 4))
+    video_paths = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for item in items:
             logger.info(f"downloading video: {item.url}")
-            saved_video_path = save_video(
-                video_url=item.url, save_dir=material_directory
+            future = executor.submit(
+                save_video,
+                item.url,
+                material_directory,
+                item.provider,
+                max_durations.get(item.url, 0),
+                pins,
             )
-            if saved_video_path:
-                logger.info(f"video saved: {saved_video_path}")
-                video_paths.append(saved_video_path)
-                seconds = min(max_clip_duration, item.duration)
-                total_duration += seconds
-                if total_duration > audio_duration:
-                    logger.info(
-                        f"total duration of downloaded videos: {total_duration} seconds, skip downloading more"
-                    )
-                    break
-        except Exception as e:
-            logger.error(f"failed to download video: {utils.to_json(item)} => {str(e)}")
-    logger.success(f"downloaded {len(video_paths)} videos")
+            futures[future] = item
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                saved_video_path = future.result()
+                if saved_video_path:
+                    logger.info(f"video saved: {saved_video_path}")
+                    video_paths[item.url] = saved_video_path
+            except Exception as e:
+                logger.error(
+                    f"failed to download video: {utils.to_json(item)} => {str(e)}"
+                )
     return video_paths
 
 
+def _download_timelines(
+    task_id: str,
+    candidates: List[MaterialInfo],
+    durations: List[float],
+    video_contact_mode: VideoConcatMode,
+    max_clip_duration: int,
+    pins: Set[str] = None,
+) -> List[List[ClipSpan]]:
+    """
+    plan a timeline of each duration from the candidates, then download only
+    the videos the timelines use. when a download fails, the timelines are
+    planned again without it, videos already downloaded are reused.
+
+    return the timelines, their spans point to the downloaded files
+    """
+    video_paths = {}
+    failed_urls = set()
+    timelines = []
+    for _ in range(3):
+        usable = [item for item in candidates if item.url not in failed_urls]
+        pool = planner.select_materials(usable, sum(durations), max_clip_duration)
+        sources = [(item.url, item.duration) for item in pool]
+        timelines = [
+            planner.plan_spans(sources, duration, video_contact_mode, max_clip_duration)
+            for duration in durations
+        ]
+
+        used_urls = set(planner.used_sources(timelines))
+        items = [
+            item
+            for item in pool
+            if item.url in used_urls and item.url not in video_paths
+        ]
+        logger.info(
+            f"timelines use {len(used_urls)} of {len(candidates)} videos, "
+            f"downloading {len(items)}"
+        )
+        # the timelines only play the beginning of most videos in sequential mode
+        max_durations = {}
+        for spans in timelines:
+            for span in spans:
+                max_durations[span.path] = max(
+                    max_durations.get(span.path, 0), span.end
+                )
+        max_durations = {
+            item.url: max_durations[item.url]
+            for item in items
+            if max_durations[item.url] < item.duration
+        }
+        downloaded = download_materials(task_id, items, max_durations, pins)
+        video_paths.update(downloaded)
+        failed = {item.url for item in items if item.url not in downloaded}
+        if not failed:
+            break
+        failed_urls |= failed
+
+    file_durations = {}
+    for video_path in video_paths.values():
+        info = material_store.get(video_path) or ffmpeg.probe(video_path)
+        file_durations[video_path] = info["duration"]
+    return [
+        planner.bind_spans(spans, video_paths, file_durations) for spans in timelines
+    ]
+
+
+def download_timelines(
+    task_id: str,
+    search_terms: List[str],
+    source: str = "pexels",
+    video_aspect: VideoAspect = VideoAspect.landscape,
+    video_contact_mode: VideoConcatMode = VideoConcatMode.random,
+    audio_duration: float = 0.0,
+    max_clip_duration: int = 5,
+    video_count: int = 1,
+    candidates: List[MaterialInfo] = None,
+    pins: Set[str] = None,
+) -> Tuple[List[str], List[List[ClipSpan]]]:
+    """
+    plan the timeline of every video from the search results first, then
+    download only the videos the timelines use.
+
+    candidates: search results to plan from, searched when not given
+    pins: see save_video
+    return (video paths, timelines), the spans of the timelines point to the
+    downloaded files
+    """
+    if candidates is None:
+        candidates = search_materials(
+            search_terms=search_terms,
+            source=source,
+            video_aspect=video_aspect,
+            video_contact_mode=video_contact_mode,
+            audio_duration=audio_duration * video_count,
+            max_clip_duration=max_clip_duration,
+        )
+
+    timelines = _download_timelines(
+        task_id,
+        candidates,
+        [audio_duration] * video_count,
+        video_contact_mode,
+        max_clip_duration,
+        pins,
+    )
+    used_paths = planner.used_sources(timelines)
+    logger.success(f"downloaded {len(used_paths)} videos")
+    return used_paths, timelines
+
+
+def extend_timelines(
+    task_id: str,
+    timelines: List[List[ClipSpan]],
+    candidates: List[MaterialInfo],
+    video_contact_mode: VideoConcatMode = VideoConcatMode.random,
+    audio_duration: float = 0.0,
+    max_clip_duration: int = 5,
+    pins: Set[str] = None,
+) -> Tuple[List[str], List[List[ClipSpan]]]:
+    """
+    top up timelines planned for a shorter audio: the spans already there are
+    kept, only the duration each timeline misses is planned from the
+    candidates no timeline uses yet, downloaded and appended.
+
+    return (video paths, timelines) like download_timelines
+    """
+    used_urls = {span.url for spans in timelines for span in spans}
+    unused = [item for item in candidates if item.url not in used_urls]
+    missing = [
+        max(audio_duration - sum(span.duration for span in spans), 0)
+        for spans in timelines
+    ]
+    logger.info(
+        f"topping up {sum(missing):.1f} seconds of footage from {len(unused)} "
+        f"unused videos"
+    )
+    if unused and sum(missing) > 0:
+        extra = _download_timelines(
+            task_id, unused, missing, video_contact_mode, max_clip_duration, pins
+        )
+        timelines = [spans + more for spans, more in zip(timelines, extra)]
+
+    used_paths = planner.used_sources(timelines)
+    logger.success(f"downloaded {len(used_paths)} videos")
+    return used_paths, timelines
+
+
 if __name__ == "__main__":
-    download_videos(
+    download_timelines(
         "test123", ["Money Exchange Medium"], audio_duration=100, source="pixabay"
     )
@@ -0,0 +1,256 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Set
+
+from loguru import logger
+
+from app.config import config
+from app.services import ffmpeg
+from app.utils import utils
+
+_COLUMNS = (
+    "path",
+    "content_hash",
+    "duration",
+    "fps",
+    "width",
+    "height",
+    "codec",
+    "size",
+    "last_access",
+)
+_gc_lock = threading.Lock()
+# files planned or rendered by running tasks, by number of tasks
+_pins = {}
+_pins_lock = threading.Lock()
+# one download and index of a url per directory at a time
+_url_locks = utils.KeyLocks()
+
+
+def _cache_dir() -> str:
+    return utils.storage_dir("cache_videos", create=True)
+
+
+def _max_size() -> int:
+    return int(config.app.get("material_cache_max_size_mb", 0)) * 1024 * 1024
+
+
+@contextmanager
+def _connect():
+    """
+    a connection inside a transaction, committed and closed on exit
+    """
+    conn = sqlite3.connect(os.path.join(_cache_dir(), "index.db"), timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            _create_tables(conn)
+            yield conn
+    finally:
+        conn.close()
+
+
+def _create_tables(conn: sqlite3.Connection):
+    # a file may be served by several urls, it is stored once per directory
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS files ("
+        " path TEXT PRIMARY KEY,"
+        " content_hash TEXT NOT NULL,"
+        " duration REAL NOT NULL,"
+        " fps REAL NOT NULL,"
+        " width INTEGER NOT NULL,"
+        " height INTEGER NOT NULL,"
+        " codec TEXT NOT NULL,"
+        " size INTEGER NOT NULL,"
+        " last_access REAL NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS urls ("
+        " url TEXT NOT NULL,"
+        " dir TEXT NOT NULL,"
+        " provider TEXT NOT NULL,"
+        " path TEXT NOT NULL,"
+        " PRIMARY KEY (url, dir))"
+    )
+
+
+def _file_hash(file_path: str) -> str:
+    h = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def url_lock(url: str, save_dir: str):
+    return _url_locks.hold((url, os.path.abspath(save_dir)))
+
+
+def _pin(file_path: str, pins: Set[str]):
+    if pins is None:
+        return
+    with _pins_lock:
+        if file_path in pins:
+            return
+        pins.add(file_path)
+        _pins[file_path] = _pins.get(file_path, 0) + 1
+
+
+@contextmanager
+def pinned():
+    """
+    yield a set collecting the files handed out with it (pins=) by lookup and
+    add, gc does not delete them until the block exits
+    """
+    pins = set()
+    try:
+        yield pins
+    finally:
+        with _pins_lock:
+            for file_path in pins:
+                _pins[file_path] -= 1
+                if not _pins[file_path]:
+                    del _pins[file_path]
+
+
+def content_path(content_hash: str, save_dir: str) -> str:
+    return os.path.join(save_dir, f"vid-{content_hash}.mp4")
+
+
+def lookup(url: str, save_dir: str, pins: Set[str] = None) -> Optional[dict]:
+    """
+    metadata of the file downloaded from url into save_dir, None when the url
+    was never downloaded there or the file is gone. pins: set from pinned()
+    """
+    save_dir = os.path.abspath(save_dir)
+    with _connect() as conn:
+        row = conn.execute(
+            f"SELECT {', '.join('f.' + c for c in _COLUMNS)} FROM urls u"
+            " JOIN files f ON f.path = u.path WHERE u.url = ? AND u.dir = ?",
+            (url, save_dir),
+        ).fetchone()
+        if not row:
+            return None
+        # pinned before checking it, gc may delete it until then
+        _pin(row["path"], pins)
+        if not os.path.isfile(row["path"]):
+            conn.execute("DELETE FROM files WHERE path = ?", (row["path"],))
+            conn.execute("DELETE FROM urls WHERE path = ?", (row["path"],))
+            return None
+        conn.execute(
+            "UPDATE files SET last_access = ? WHERE path = ?",
+            (time.time(), row["path"]),
+        )
+        return dict(row)
+
+
+def get(file_path: str) -> Optional[dict]:
+    """
+    metadata of an indexed file, without probing it again
+    """
+    with _connect() as conn:
+        row = conn.execute(
+            f"SELECT {', '.join(_COLUMNS)} FROM files WHERE path = ?",
+            (os.path.abspath(file_path),),
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def add(url: str, provider: str, file_path: str, pins: Set[str] = None) -> dict:
+    """
+    move a downloaded file to its content addressed name (vid-<sha1>.mp4) in
+    its directory and index it, a file with the same content is kept only
+    once. raise ValueError when the file is not a valid video.
+    pins: set from pinned()
+    """
+    save_dir = os.path.dirname(os.path.abspath(file_path))
+    content_hash = _file_hash(file_path)
+    video_path = content_path(content_hash, save_dir)
+    _pin(video_path, pins)
+
+    info = get(video_path) if os.path.isfile(video_path) else None
+    if info:
+        logger.info(f"same video already stored: {url} => {video_path}")
+        if os.path.abspath(file_path) != video_path:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+    else:
+        probe = ffmpeg.probe(file_path)
+        if not (probe["duration"] > 0 and probe["fps"] > 0):
+            raise ValueError(f"invalid video file: {file_path}")
+        try:
+            os.replace(file_path, video_path)
+        except FileNotFoundError:
+            # another caller stored the same file first
+            if not os.path.isfile(video_path):
+                raise
+            logger.info(f"same video already stored: {url} => {video_path}")
+        info = {
+            "path": video_path,
+            "content_hash": content_hash,
+            "duration": probe["duration"],
+            "fps": probe["fps"],
+            "width": probe["width"],
+            "height": probe["height"],
+            "codec": probe["codec"],
+            "size": os.path.getsize(video_path),
+            "last_access": time.time(),
+        }
+
+    with _connect() as conn:
+        conn.execute(
+            f"INSERT OR REPLACE INTO files ({', '.join(_COLUMNS)})"
+            f" VALUES ({', '.join('?' * len(_COLUMNS))})",
+            tuple(info[c] for c in _COLUMNS),
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO urls (url, dir, provider, path)"
+            " VALUES (?, ?, ?, ?)",
+            (url, save_dir, provider or "", video_path),
+        )
+
+    if save_dir == os.path.abspath(_cache_dir()):
+        gc()
+    return info
+
+
+def gc():
+    """
+    delete the least recently used files of storage/cache_videos until they
+    fit in material_cache_max_size_mb, 0 keeps everything. files pinned by a
+    running task are kept.
+    """
+    max_size = _max_size()
+    if max_size <= 0:
+        return
+
+    cache_dir = os.path.abspath(_cache_dir())
+    with _gc_lock, _connect() as conn:
+        rows = conn.execute(
+            "SELECT path, size FROM files WHERE path LIKE ? ORDER BY last_access",
+            (os.path.join(cache_dir, "%"),),
+        ).fetchall()
+        total_size = sum(row["size"] for row in rows)
+        for row in rows:
+            if total_size <= max_size:
+                break
+            with _pins_lock:
+                if row["path"] in _pins:
+                    continue
+                try:
+                    os.remove(row["path"])
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"failed to delete video: {row['path']} => {str(e)}")
+                    continue
+            conn.execute("DELETE FROM files WHERE path = ?", (row["path"],))
+            conn.execute("DELETE FROM urls WHERE path = ?", (row["path"],))
+            total_size -= row["size"]
+            logger.info(f"evicted video: {row['path']}")
@@ -0,0 +1,78 @@
+import numpy as np
+from loguru import logger
+from moviepy.editor import VideoClip
+from PIL import Image
+
+from app.models.schema import VideoAspect
+
+_FPS = 30
+
+
+def _fit_size(width: int, height: int, video_aspect: VideoAspect):
+    """
+    size of the image scaled to fit inside the target resolution, even numbers
+    so the video can be encoded as yuv420p
+    """
+    video_width, video_height = VideoAspect(video_aspect).to_resolution()
+    scale = min(video_width / width, video_height / height)
+    fit_width = max(int(width * scale) // 2 * 2, 2)
+    fit_height = max(int(height * scale) // 2 * 2, 2)
+    return fit_width, fit_height
+
+
+def _crop_indices(source_size: int, output_size: int, zooms: np.ndarray):
+    """
+    source pixel of every output pixel along one axis, one row per frame,
+    the centered window shows 1 / zoom of the source
+    """
+    windows = source_size / zooms
+    offsets = (source_size - windows) / 2
+    steps = windows / output_size
+    pixels = np.arange(output_size) + 0.5
+    indices = offsets[:, None] + pixels[None, :] * steps[:, None]
+    return np.clip(indices.astype(np.intp), 0, source_size - 1)
+
+
+def image_to_video(
+    image_path: str,
+    output_file: str,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    duration: float = 4,
+    zoom_rate: float = 0.03,
+) -> str:
+    """
+    slowly zoom into the center of the image (ken burns), the zoom goes from
+    1 to 1 + duration * zoom_rate.
+
+    the image is resized once to the output size times the final zoom, each
+    frame is then a precomputed crop window picked from it with numpy indexing,
+    instead of resizing the full resolution image for every frame.
+    """
+    max_zoom = 1 + duration * zoom_rate
+    with Image.open(image_path) as image:
+        image = image.convert("RGB")
+        width, height = _fit_size(image.width, image.height, video_aspect)
+        source_size = (round(width * max_zoom), round(height * max_zoom))
+        source = np.asarray(image.resize(source_size, Image.LANCZOS))
+
+    frame_count = max(int(round(duration * _FPS)), 1)
+    zooms = 1 + (max_zoom - 1) * np.arange(frame_count) / frame_count
+    rows = _crop_indices(source.shape[0], height, zooms)
+    cols = _crop_indices(source.shape[1], width, zooms)
+
+    def make_frame(t):
+        i = min(int(t * _FPS + 0.5), frame_count - 1)
+        return source.take(rows[i], axis=0).take(cols[i], axis=1)
+
+    clip = VideoClip(make_frame, duration=duration)
+    clip.write_videofile(
+        output_file,
+        fps=_FPS,
+        codec="libx264",
+        preset="veryfast",
+        audio=False,
+        logger=None,
+    )
+    clip.close()
+    logger.debug(f"image to video: {image_path} => {width}x{height}, {duration}s")
+    return output_file
@@ -0,0 +1,141 @@
+import struct
+from typing import Iterator, List, Optional, Tuple
+
+# boxes holding the sample tables of a track
+_CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+
+
+def iter_boxes(data: bytes, start: int = 0, end: int = None) -> Iterator[Tuple]:
+    """
+    yield (type, payload start, box end) of the boxes in data[start:end], the
+    end of the last box may lie past the end of data
+    """
+    end = len(data) if end is None else end
+    while start + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, start)
+        header = 8
+        if size == 1:
+            if start + 16 > end:
+                return
+            size = struct.unpack_from(">Q", data, start + 8)[0]
+            header = 16
+        elif size == 0:
+            # the box extends to the end of the file
+            size = end - start
+        if size < header:
+            return
+        yield box_type, start + header, start + size
+        start += size
+
+
+def find_moov(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    (start, end) of the moov box when it comes before the media data
+    (faststart), None when data does not show one
+    """
+    start = 0
+    for box_type, _, box_end in iter_boxes(data):
+        if box_type == b"moov":
+            return start, box_end
+        if box_type == b"mdat":
+            return None
+        start = box_end
+    return None
+
+
+def _children(data: bytes, start: int, end: int) -> dict:
+    return {t: (s, e) for t, s, e in iter_boxes(data, start, end)}
+
+
+def _tracks(moov: bytes) -> List[dict]:
+    """
+    the boxes of each track, by type, flattened from trak/mdia/minf/stbl
+    """
+    tracks = []
+    for box_type, start, end in iter_boxes(moov, 8):
+        if box_type != b"trak":
+            continue
+        boxes = {}
+        pending = [(start, end)]
+        while pending:
+            s, e = pending.pop()
+            for t, (cs, ce) in _children(moov, s, e).items():
+                boxes[t] = (cs, ce)
+                if t in _CONTAINERS:
+                    pending.append((cs, ce))
+        tracks.append(boxes)
+    return tracks
+
+
+def _timescale(moov: bytes, mdhd: Tuple[int, int]) -> int:
+    start = mdhd[0]
+    version = moov[start]
+    # version 1 uses 64 bit creation and modification times
+    offset = start + (20 if version == 1 else 12)
+    return struct.unpack_from(">I", moov, offset)[0]
+
+
+def _entries(moov: bytes, box: Tuple[int, int], fmt: str) -> List[tuple]:
+    start = box[0]
+    count = struct.unpack_from(">I", moov, start + 4)[0]
+    size = struct.calcsize(fmt)
+    return [struct.unpack_from(fmt, moov, start + 8 + i * size) for i in range(count)]
+
+
+def _sample_sizes(moov: bytes, stsz: Tuple[int, int]) -> List[int]:
+    start = stsz[0]
+    sample_size, count = struct.unpack_from(">II", moov, start + 4)
+    if sample_size:
+        return [sample_size] * count
+    return list(struct.unpack_from(f">{count}I", moov, start + 12))
+
+
+def prefix_size(moov: bytes, duration: float) -> Optional[int]:
+    """
+    number of leading bytes of the file that hold every video sample decoded
+    in the first duration seconds, moov is the whole moov box. None when the
+    file has no video track or uses tables this parser does not know.
+    """
+    for boxes in _tracks(moov):
+        hdlr = boxes.get(b"hdlr")
+        if not hdlr or moov[hdlr[0] + 8 : hdlr[0] + 12] != b"vide":
+            continue
+        required = (b"mdhd", b"stts", b"stsc", b"stsz")
+        if any(t not in boxes for t in required):
+            return None
+        if b"stco" in boxes:
+            chunk_offsets = [o for (o,) in _entries(moov, boxes[b"stco"], ">I")]
+        elif b"co64" in boxes:
+            chunk_offsets = [o for (o,) in _entries(moov, boxes[b"co64"], ">Q")]
+        else:
+            return None
+
+        # samples decoded before the duration
+        limit = duration * _timescale(moov, boxes[b"mdhd"])
+        sample_count = 0
+        dts = 0
+        for count, delta in _entries(moov, boxes[b"stts"], ">II"):
+            if delta and dts + count * delta >= limit:
+                sample_count += int((limit - dts + delta - 1) // delta)
+                break
+            sample_count += count
+            dts += count * delta
+
+        sizes = _sample_sizes(moov, boxes[b"stsz"])
+        sample_count = min(max(sample_count, 1), len(sizes))
+        stsc = _entries(moov, boxes[b"stsc"], ">III")
+
+        end = 0
+        sample = 0
+        for i, (first_chunk, samples_per_chunk, _) in enumerate(stsc):
+            last_chunk = stsc[i + 1][0] if i + 1 < len(stsc) else len(chunk_offsets) + 1
+            for chunk in range(first_chunk, last_chunk):
+                offset = chunk_offsets[chunk - 1]
+                for _ in range(samples_per_chunk):
+                    if sample >= sample_count:
+                        return end
+                    offset += sizes[sample]
+                    end = max(end, offset)
+                    sample += 1
+        return end
+    return None
@@ -0,0 +1,102 @@
+import random
+from typing import Dict, List, Tuple
+
+from app.models.schema import ClipSpan, MaterialInfo, VideoConcatMode
+
+
+def plan_spans(
+    sources: List[Tuple[str, float]],
+    audio_duration: float,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    max_clip_duration: int = 5,
+) -> List[ClipSpan]:
+    """
+    decide which part of which source is used at which position of the
+    timeline, sources are (path or url, duration) pairs
+    """
+    raw_spans = []
+    for source, clip_duration in sources:
+        start_time = 0
+        while start_time < clip_duration:
+            end_time = min(start_time + max_clip_duration, clip_duration)
+            raw_spans.append(ClipSpan(path=source, start=start_time, end=end_time))
+            start_time = end_time
+            if video_concat_mode.value == VideoConcatMode.sequential.value:
+                break
+
+    # random video_paths order
+    if video_concat_mode.value == VideoConcatMode.random.value:
+        random.shuffle(raw_spans)
+
+    return fit_spans(raw_spans, audio_duration)
+
+
+def fit_spans(spans: List[ClipSpan], duration: float) -> List[ClipSpan]:
+    """
+    repeat the spans until they last duration seconds, the last one is cut
+    """
+    fitted = []
+    if not spans:
+        return fitted
+
+    # Add downloaded clips over and over until the duration of the audio (max_duration) has been reached
+    video_duration = 0
+    while video_duration < duration:
+        for span in spans:
+            remaining = duration - video_duration
+            if remaining <= 0:
+                break
+            end_time = min(span.end, span.start + remaining)
+            fitted.append(ClipSpan(path=span.path, start=span.start, end=end_time))
+            video_duration += end_time - span.start
+    return fitted
+
+
+def select_materials(
+    candidates: List[MaterialInfo], required_duration: float, max_clip_duration: int
+) -> List[MaterialInfo]:
+    """
+    the first candidates whose usable footage (at most max_clip_duration
+    seconds each) covers required_duration
+    """
+    selected = []
+    total_duration = 0.0
+    for item in candidates:
+        selected.append(item)
+        total_duration += min(max_clip_duration, item.duration)
+        if total_duration > required_duration:
+            break
+    return selected
+
+
+def used_sources(timelines: List[List[ClipSpan]]) -> List[str]:
+    """
+    sources referenced by the timelines, in order of first use
+    """
+    sources = {}
+    for spans in timelines:
+        for span in spans:
+            sources.setdefault(span.path, None)
+    return list(sources)
+
+
+def bind_spans(
+    spans: List[ClipSpan], paths: Dict[str, str], durations: Dict[str, float]
+) -> List[ClipSpan]:
+    """
+    replace the urls of planned spans by the downloaded files, spans are cut
+    to the real duration of the files (search results give rounded durations)
+    and dropped when their file is missing
+    """
+    bound = []
+    for span in spans:
+        path = paths.get(span.path)
+        if not path:
+            continue
+        duration = durations.get(path, span.end)
+        end_time = min(span.end, duration)
+        if end_time - span.start > 0.1:
+            bound.append(
+                ClipSpan(path=path, start=span.start, end=end_time, url=span.path)
+            )
+    return bound
@@ -0,0 +1,155 @@
+import os
+from typing import List
+
+from loguru import logger
+
+from app.models.schema import ClipSpan, VideoAspect, VideoParams
+from app.services import ffmpeg, subtitle_ass
+from app.services.video import get_bgm_file
+
+
+def _audio_graph(
+    audio_path: str, params: VideoParams, input_index: int, duration: float
+):
+    """
+    inputs and filters mixing the voice with the looped bgm,
+    return (args, filters, output label)
+    """
+    args = ["-i", audio_path]
+    filters = [f"[{input_index}:a]volume={params.voice_volume}[voice]"]
+    label = "voice"
+
+    bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
+    if bgm_file:
+        args += ["-stream_loop", "-1", "-i", bgm_file]
+        fade_start = max(duration - 3, 0)
+        filters.append(
+            f"[{input_index + 1}:a]volume={params.bgm_volume},"
+            f"atrim=0:{duration:.3f},"
+            f"afade=t=out:st={fade_start:.3f}:d=3[bgm]"
+        )
+        # amix halves each input, restore the levels to match CompositeAudioClip
+        filters.append(
+            "[voice][bgm]amix=inputs=2:duration=longest:dropout_transition=0,volume=2[aout]"
+        )
+        label = "aout"
+    return args, filters, label
+
+
+def mix_audio(
+    audio_path: str, output_file: str, params: VideoParams, duration: float
+) -> str:
+    """
+    mix the voice and the bgm once into an aac file shared by all variants
+    """
+    args, filters, label = _audio_graph(audio_path, params, 0, duration)
+    ffmpeg.run(
+        [
+            "-loglevel",
+            "error",
+            *args,
+            "-filter_complex",
+            ";".join(filters),
+            "-map",
+            f"[{label}]",
+            "-t",
+            f"{duration:.3f}",
+            "-c:a",
+            "aac",
+            "-b:a",
+            "192k",
+            output_file,
+        ]
+    )
+    return output_file
+
+
+def render_video(
+    spans: List[ClipSpan],
+    audio_path: str,
+    subtitle_path: str,
+    output_file: str,
+    params: VideoParams,
+    audio_mixed: bool = False,
+    ass_path: str = "",
+) -> str:
+    """
+    render the whole timeline (trim, scale/pad, concat, subtitles, voice + bgm)
+    with a single ffmpeg filtergraph, every frame is decoded and encoded once
+
+    audio_mixed: audio_path already contains the voice and bgm at their volumes
+    ass_path: subtitle already exported by subtitle_ass, exported when not given
+    """
+    if not spans:
+        raise ValueError("no video clips to render")
+
+    aspect = VideoAspect(params.video_aspect)
+    video_width, video_height = aspect.to_resolution()
+    total_duration = sum(span.duration for span in spans)
+
+    logger.info(f"start, video size: {video_width} x {video_height}")
+    logger.info(f"  ① clips: {len(spans)}, duration: {total_duration:.2f} seconds")
+    logger.info(f"  ② audio: {audio_path}")
+    logger.info(f"  ③ subtitle: {subtitle_path}")
+    logger.info(f"  ④ output: {output_file}")
+
+    args = ["-loglevel", "error"]
+    filters = []
+    for i, span in enumerate(spans):
+        args += ["-ss", f"{span.start:.3f}", "-t", f"{span.duration:.3f}"]
+        args += ["-i", span.path]
+        filters.append(
+            f"[{i}:v]fps=30,"
+            f"scale={video_width}:{video_height}:force_original_aspect_ratio=decrease,"
+            f"pad={video_width}:{video_height}:(ow-iw)/2:(oh-ih)/2:color=black,"
+            f"setsar=1,format=yuv420p,setpts=PTS-STARTPTS[v{i}]"
+        )
+    concat_inputs = "".join(f"[v{i}]" for i in range(len(spans)))
+    filters.append(f"{concat_inputs}concat=n={len(spans)}:v=1:a=0[vcat]")
+
+    video_label = "vcat"
+    if params.subtitle_enabled and subtitle_path and os.path.exists(subtitle_path):
+        if not ass_path:
+            ass_path = subtitle_ass.create_ass_file(subtitle_path, params)
+        filters.append(f"[vcat]{subtitle_ass.burn_filter(ass_path)}[vout]")
+        video_label = "vout"
+
+    if audio_mixed:
+        args += ["-i", audio_path]
+        audio_map = f"{len(spans)}:a"
+    else:
+        audio_args, audio_filters, audio_label = _audio_graph(
+            audio_path, params, len(spans), total_duration
+        )
+        args += audio_args
+        filters += audio_filters
+        audio_map = f"[{audio_label}]"
+
+    args += [
+        "-filter_complex",
+        ";".join(filters),
+        "-map",
+        f"[{video_label}]",
+        "-map",
+        audio_map,
+        "-t",
+        f"{total_duration:.3f}",
+        "-r",
+        "30",
+        "-c:v",
+        "libx264",
+        "-preset",
+        "medium",
+        "-pix_fmt",
+        "yuv420p",
+        "-c:a",
+        "copy" if audio_mixed else "aac",
+        "-threads",
+        str(params.n_threads or 2),
+        "-movflags",
+        "+faststart",
+        output_file,
+    ]
+    ffmpeg.run(args)
+    logger.success("completed")
+    return output_file
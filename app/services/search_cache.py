@@ -0,0 +1,116 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from loguru import logger
+
+from app.config import config
+from app.utils import utils
+
+
+def _ttl() -> int:
+    return int(config.app.get("search_cache_ttl", 86400))
+
+
+def _max_entries() -> int:
+    return int(config.app.get("search_cache_max_entries", 10000))
+
+
+@contextmanager
+def _connect():
+    """
+    a connection inside a transaction, committed and closed on exit
+    """
+    db_file = os.path.join(utils.storage_dir("cache_search", create=True), "search.db")
+    conn = sqlite3.connect(db_file, timeout=30)
+    try:
+        with conn:
+            _create_table(conn)
+            yield conn
+    finally:
+        conn.close()
+
+
+def _create_table(conn: sqlite3.Connection):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS search_results ("
+        " provider TEXT NOT NULL,"
+        " term TEXT NOT NULL,"
+        " orientation TEXT NOT NULL,"
+        " per_page INTEGER NOT NULL,"
+        " videos TEXT NOT NULL,"
+        " created_at REAL NOT NULL,"
+        " accessed_at REAL NOT NULL,"
+        " PRIMARY KEY (provider, term, orientation, per_page))"
+    )
+
+
+def _normalize_term(term: str) -> str:
+    return " ".join(term.lower().split())
+
+
+def get(provider: str, term: str, orientation: str, per_page: int):
+    """
+    return the cached videos of a search, None when missing or expired
+    """
+    ttl = _ttl()
+    if ttl <= 0:
+        return None
+
+    key = (provider, _normalize_term(term), orientation, per_page)
+    try:
+        with _connect() as conn:
+            row = conn.execute(
+                "SELECT videos, created_at FROM search_results"
+                " WHERE provider=? AND term=? AND orientation=? AND per_page=?",
+                key,
+            ).fetchone()
+            if not row:
+                return None
+            videos, created_at = row
+            if time.time() - created_at > ttl:
+                return None
+            conn.execute(
+                "UPDATE search_results SET accessed_at=?"
+                " WHERE provider=? AND term=? AND orientation=? AND per_page=?",
+                (time.time(), *key),
+            )
+        logger.debug(f"search cache hit: {provider}, {term}")
+        return json.loads(videos)
+    except Exception as e:
+        logger.warning(f"failed to read search cache: {str(e)}")
+        return None
+
+
+def put(provider: str, term: str, orientation: str, per_page: int, videos: list):
+    """
+    store the videos of a search, then drop expired entries and the least
+    recently used ones above search_cache_max_entries
+    """
+    ttl = _ttl()
+    if ttl <= 0:
+        return
+
+    now = time.time()
+    key = (provider, _normalize_term(term), orientation, per_page)
+    try:
+        with _connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO search_results"
+                " (provider, term, orientation, per_page, videos, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*key, json.dumps(videos), now, now),
+            )
+            conn.execute(
+                "DELETE FROM search_results WHERE created_at < ?", (now - ttl,)
+            )
+            conn.execute(
+                "DELETE FROM search_results WHERE rowid IN ("
+                " SELECT rowid FROM search_results ORDER BY accessed_at DESC"
+                " LIMIT -1 OFFSET ?)",
+                (_max_entries(),),
+            )
+    except Exception as e:
+        logger.warning(f"failed to write search cache: {str(e)}")
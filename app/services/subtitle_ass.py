@@ -0,0 +1,153 @@
+import os
+from typing import Tuple
+
+from loguru import logger
+from moviepy.video.tools.subtitles import file_to_subtitles
+from PIL import ImageColor
+
+from app.models.schema import VideoAspect, VideoParams
+from app.services import ffmpeg, layout
+from app.utils import utils
+
+
+def _ass_color(color: str) -> str:
+    """
+    #RRGGBB => &HAABBGGRR, "transparent" => fully transparent black
+    """
+    if not color or color == "transparent":
+        return "&HFF000000"
+    try:
+        rgb = ImageColor.getrgb(color)
+    except ValueError:
+        logger.warning(f"invalid color: {color}, using white")
+        rgb = (255, 255, 255)
+    r, g, b = rgb[:3]
+    alpha = 255 - rgb[3] if len(rgb) == 4 else 0
+    return f"&H{alpha:02X}{b:02X}{g:02X}{r:02X}"
+
+
+def _ass_time(seconds: float) -> str:
+    centiseconds = int(round(max(seconds, 0) * 100))
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    seconds, centiseconds = divmod(centiseconds, 100)
+    return f"{hours}:{minutes:02d}:{seconds:02d}.{centiseconds:02d}"
+
+
+def _ass_text(text: str) -> str:
+    # braces start override blocks, new lines are written as \N
+    text = text.replace("{", "(").replace("}", ")")
+    return "\\N".join(line.strip() for line in text.splitlines())
+
+
+def _font_info(font_path: str, font_size: int) -> Tuple[str, int]:
+    """
+    return (family name, ass font size), libass sizes a font by its
+    ascent + descent while Pillow sizes it by its em square
+    """
+    try:
+        font = layout.load_font(font_path, font_size)
+        ascent, descent = font.getmetrics()
+        return font.getname()[0], ascent + descent
+    except Exception as e:
+        logger.warning(f"failed to read font: {font_path} => {str(e)}")
+        return os.path.splitext(os.path.basename(font_path))[0], font_size
+
+
+def create_ass_file(subtitle_path: str, params: VideoParams, ass_path: str = "") -> str:
+    """
+    convert the srt subtitle into an ass file carrying the VideoParams styling,
+    lines are wrapped and placed the same way as the Pillow rendered subtitles
+    """
+    if not ass_path:
+        ass_path = f"{os.path.splitext(subtitle_path)[0]}.ass"
+
+    aspect = VideoAspect(params.video_aspect)
+    video_width, video_height = aspect.to_resolution()
+
+    if not params.font_name:
+        params.font_name = "STHeitiMedium.ttc"
+    font_path = os.path.join(utils.font_dir(), params.font_name)
+    font_family, font_size = _font_info(font_path, params.font_size)
+
+    # numpad alignment, 2 = bottom center, 8 = top center, 5 = middle center
+    margin_v = int(video_height * 0.05)
+    if params.subtitle_position == "bottom":
+        alignment = 2
+    elif params.subtitle_position == "top":
+        alignment = 8
+    else:  # center, custom lines are positioned one by one
+        alignment, margin_v = 5, 0
+
+    border_style = 1
+    outline_color = _ass_color(params.stroke_color)
+    outline = params.stroke_width
+    if params.text_background_color and params.text_background_color != "transparent":
+        # opaque box, drawn with the outline color
+        border_style = 3
+        outline_color = _ass_color(params.text_background_color)
+        outline = max(params.stroke_width, 1)
+
+    margin_h = int(video_width * 0.05)
+    lines = [
+        "[Script Info]",
+        "ScriptType: v4.00+",
+        f"PlayResX: {video_width}",
+        f"PlayResY: {video_height}",
+        # lines are wrapped below, libass must not wrap them again
+        "WrapStyle: 2",
+        "ScaledBorderAndShadow: yes",
+        "",
+        "[V4+ Styles]",
+        "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, "
+        "OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, "
+        "ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, "
+        "MarginL, MarginR, MarginV, Encoding",
+        f"Style: Default,{font_family},{font_size},"
+        f"{_ass_color(params.text_fore_color)},&H000000FF,{outline_color},"
+        f"&HFF000000,0,0,0,0,100,100,0,0,{border_style},{outline},0,"
+        f"{alignment},{margin_h},{margin_h},{margin_v},1",
+        "",
+        "[Events]",
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, "
+        "Effect, Text",
+    ]
+
+    max_width = video_width * 0.9
+    for (start_time, end_time), phrase in file_to_subtitles(
+        subtitle_path, encoding="utf-8"
+    ):
+        wrapped_txt, txt_height = layout.wrap_text(
+            phrase, max_width=max_width, font=font_path, fontsize=params.font_size
+        )
+        override = ""
+        if params.subtitle_position == "custom":
+            # 确保字幕完全在屏幕内
+            margin = 10
+            max_y = video_height - txt_height - margin
+            custom_y = (video_height - txt_height) * (params.custom_position / 100)
+            y = max(margin, min(custom_y, max_y))
+            override = f"{{\\an8\\pos({video_width / 2:.0f},{y:.0f})}}"
+        lines.append(
+            f"Dialogue: 0,{_ass_time(start_time)},{_ass_time(end_time)},"
+            f"Default,,0,0,0,,{override}{_ass_text(wrapped_txt)}"
+        )
+
+    # variants of a task may export at the same time, replace the file atomically
+    tmp_path = f"{ass_path}.{utils.get_uuid(True)}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, ass_path)
+    logger.info(f"ass subtitle created: {ass_path}")
+    return ass_path
+
+
+def burn_filter(ass_path: str) -> str:
+    """
+    ffmpeg filter burning the ass file with libass, fonts are loaded from the
+    resource directory
+    """
+    return (
+        f"ass=filename={ffmpeg.escape_filter_value(ass_path)}"
+        f":fontsdir={ffmpeg.escape_filter_value(utils.font_dir())}"
+    )
@@ -0,0 +1,131 @@
+import bisect
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from moviepy.editor import VideoClip
+from PIL import Image, ImageColor, ImageDraw
+
+from app.services import layout
+
+# rendered subtitle lines, shared by all tasks of the process, scripts
+# rarely repeat lines so only the latest few MB are kept
+_MAX_SPRITES_BYTES = 64 * 1024 * 1024
+_sprites = OrderedDict()
+_sprites_bytes = 0
+_lock = threading.Lock()
+
+_EMPTY_FRAME = np.zeros((1, 1, 3), dtype=np.uint8)
+_EMPTY_MASK = np.zeros((1, 1), dtype=np.float32)
+
+
+def _parse_color(color: str):
+    if not color or color == "transparent":
+        return 0, 0, 0, 0
+    rgb = ImageColor.getrgb(color)
+    if len(rgb) == 3:
+        return (*rgb, 255)
+    return rgb
+
+
+def _render(
+    text: str,
+    font_path: str,
+    font_size: int,
+    color: str,
+    bg_color: str,
+    stroke_color: str,
+    stroke_width: float,
+):
+    font = layout.load_font(font_path, font_size)
+    stroke = int(round(stroke_width or 0))
+    draw = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    left, top, right, bottom = draw.multiline_textbbox(
+        (0, 0), text, font=font, stroke_width=stroke, align="center"
+    )
+    left, top = math.floor(left), math.floor(top)
+    width = max(math.ceil(right) - left, 1)
+    height = max(math.ceil(bottom) - top, 1)
+
+    image = Image.new("RGBA", (width, height), _parse_color(bg_color))
+    ImageDraw.Draw(image).multiline_text(
+        (-left, -top),
+        text,
+        font=font,
+        fill=_parse_color(color),
+        stroke_width=stroke,
+        stroke_fill=_parse_color(stroke_color),
+        align="center",
+    )
+    rgba = np.asarray(image)
+    rgb = np.ascontiguousarray(rgba[:, :, :3])
+    # the alpha channel, scaled to a 0-1 mask frame when it is shown
+    mask = np.ascontiguousarray(rgba[:, :, 3])
+    return rgb, mask
+
+
+def render_sprite(
+    text: str,
+    font_path: str,
+    font_size: int,
+    color: str = "#FFFFFF",
+    bg_color: str = "transparent",
+    stroke_color: str = "#000000",
+    stroke_width: float = 1.5,
+):
+    """
+    rasterize a (wrapped) subtitle line with Pillow, return (rgb, mask) uint8
+    arrays, identical lines are rendered only once
+    """
+    global _sprites_bytes
+    key = (text, font_path, font_size, color, bg_color, stroke_color, stroke_width)
+    with _lock:
+        sprite = _sprites.get(key)
+        if sprite is not None:
+            _sprites.move_to_end(key)
+            return sprite
+
+    sprite = _render(
+        text, font_path, font_size, color, bg_color, stroke_color, stroke_width
+    )
+    with _lock:
+        if key not in _sprites:
+            _sprites[key] = sprite
+            _sprites_bytes += sprite[0].nbytes + sprite[1].nbytes
+        while _sprites_bytes > _MAX_SPRITES_BYTES and len(_sprites) > 1:
+            rgb, mask = _sprites.popitem(last=False)[1]
+            _sprites_bytes -= rgb.nbytes + mask.nbytes
+    return sprite
+
+
+def create_overlay_clip(items: list, duration: float) -> VideoClip:
+    """
+    one clip for the whole subtitle track, showing the sprite active at t
+
+    items: [(start, end, rgb, mask, (x, y))] sorted by start, mask holds the
+    uint8 alpha channel
+    """
+    starts = [item[0] for item in items]
+
+    def active(t):
+        i = bisect.bisect_right(starts, t) - 1
+        if i >= 0 and t < items[i][1]:
+            return items[i]
+        return None
+
+    def make_frame(t):
+        item = active(t)
+        return item[2] if item else _EMPTY_FRAME
+
+    def make_mask(t):
+        item = active(t)
+        return item[3].astype(np.float32) / 255 if item else _EMPTY_MASK
+
+    def position(t):
+        item = active(t)
+        return item[4] if item else (0, 0)
+
+    clip = VideoClip(make_frame, duration=duration, has_constant_size=False)
+    mask = VideoClip(make_mask, ismask=True, duration=duration, has_constant_size=False)
+    return clip.set_mask(mask).set_position(position)
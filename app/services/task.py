@@ -1,6 +1,8 @@
 import math
 import os.path
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from os import path
 
 from edge_tts import SubMaker
@@ -9,7 +11,19 @@ from loguru import logger
 from app.config import config
 from app.models import const
 from app.models.schema import VideoConcatMode, VideoParams
-from app.services import llm, material, subtitle, video, voice
+from app.services import (
+    audio_analysis,
+    ffmpeg,
+    llm,
+    material,
+    material_store,
+    planner,
+    renderer,
+    subtitle,
+    subtitle_ass,
+    video,
+    voice,
+)
 from app.services import state as sm
 from app.utils import utils
 
@@ -71,7 +85,11 @@ def save_script_data(task_id, video_script, video_terms, params):
         f.write(utils.to_json(script_data))
 
 
-def generate_audio(task_id, params, video_script):
+def generate_audio(task_id, params, video_script, on_word_boundary=None):
+    """
+    return (audio_file, audio_info, sub_maker), audio_info holds the exact
+    duration, loudness and silences measured from the encoded file
+    """
     logger.info("\n\n## generating audio")
     audio_file = path.join(utils.task_dir(task_id), "audio.mp3")
     sub_maker = voice.tts(
@@ -79,6 +97,7 @@ def generate_audio(task_id, params, video_script):
         voice_name=voice.parse_voice_name(params.voice_name),
         voice_rate=params.voice_rate,
         voice_file=audio_file,
+        on_word_boundary=on_word_boundary,
     )
     if sub_maker is None:
         sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
@@ -90,11 +109,17 @@ def generate_audio(task_id, params, video_script):
         )
         return None, None, None
 
-    audio_duration = math.ceil(voice.get_audio_duration(sub_maker))
-    return audio_file, audio_duration, sub_maker
+    try:
+        audio_info = audio_analysis.analyze(audio_file)
+    except Exception as e:
+        logger.warning(f"failed to analyze audio: {str(e)}")
+        audio_info = {"duration": math.ceil(voice.get_audio_duration(sub_maker))}
+    return audio_file, audio_info, sub_maker
 
 
-def generate_subtitle(task_id, params, video_script, sub_maker, audio_file):
+def generate_subtitle(
+    task_id, params, video_script, sub_maker, audio_file, subtitle_builder=None
+):
     if not params.subtitle_enabled:
         return ""
 
@@ -104,9 +129,13 @@ def generate_subtitle(task_id, params, video_script, sub_maker, audio_file):
 
     subtitle_fallback = False
     if subtitle_provider == "edge":
-        voice.create_subtitle(
-            text=video_script, sub_maker=sub_maker, subtitle_file=subtitle_path
-        )
+        if subtitle_builder:
+            # built while the audio was synthesized
+            subtitle_builder.write(subtitle_path)
+        else:
+            voice.create_subtitle(
+                text=video_script, sub_maker=sub_maker, subtitle_file=subtitle_path
+            )
         if not os.path.exists(subtitle_path):
             subtitle_fallback = True
             logger.warning("subtitle file not found, fallback to whisper")
@@ -124,89 +153,373 @@ def generate_subtitle(task_id, params, video_script, sub_maker, audio_file):
     return subtitle_path
 
 
-def get_video_materials(task_id, params, video_terms, audio_duration):
+def _video_concat_mode(params):
+    # the variants of a task differ by their random order
+    if params.video_count == 1:
+        return params.video_concat_mode
+    return VideoConcatMode.random
+
+
+def get_video_materials(task_id, params, video_terms, audio_duration, pins=None):
+    """
+    return (video paths, timelines), timelines hold the planned spans of each
+    video and are None for local materials, (None, None) on failure.
+    pins: set from material_store.pinned() holding the downloaded videos
+    """
     if params.video_source == "local":
         logger.info("\n\n## preprocess local materials")
         materials = video.preprocess_video(
-            materials=params.video_materials, clip_duration=params.video_clip_duration
+            materials=params.video_materials,
+            clip_duration=params.video_clip_duration,
+            video_aspect=params.video_aspect,
         )
         if not materials:
             sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
             logger.error(
                 "no valid materials found, please check the materials and try again."
             )
-            return None
-        return [material_info.url for material_info in materials]
+            return None, None
+        return [material_info.url for material_info in materials], None
     else:
         logger.info(f"\n\n## downloading videos from {params.video_source}")
-        downloaded_videos = material.download_videos(
+        video_concat_mode = _video_concat_mode(params)
+        downloaded_videos, timelines = material.download_timelines(
             task_id=task_id,
             search_terms=video_terms,
             source=params.video_source,
             video_aspect=params.video_aspect,
-            video_contact_mode=params.video_concat_mode,
-            audio_duration=audio_duration * params.video_count,
+            video_contact_mode=video_concat_mode,
+            audio_duration=audio_duration,
             max_clip_duration=params.video_clip_duration,
+            video_count=params.video_count,
+            pins=pins,
         )
         if not downloaded_videos:
             sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
             logger.error(
                 "failed to download videos, maybe the network is not available. if you are in China, please use a VPN."
             )
-            return None
-        return downloaded_videos
+            return None, None
+        return downloaded_videos, timelines
+
+
+def generate_audio_and_materials(task_id, params, video_script, video_terms, pins=None):
+    """
+    pipelined mode: the materials are searched and downloaded while the audio
+    is synthesized. the word boundaries feed a subtitle builder as they
+    arrive, once pipeline_estimate_share of the script is spoken the whole
+    duration is extrapolated from it and the materials are planned for it
+    (plus pipeline_duration_margin). when the real audio is longer, the
+    materials are topped up with videos the timelines do not use yet.
+
+    return (audio_file, audio_info, sub_maker, subtitle_builder,
+    downloaded_videos, timelines)
+    """
+    estimate_share = config.app.get("pipeline_estimate_share", 0.2)
+    margin = config.app.get("pipeline_duration_margin", 0.1)
+    subtitle_builder = voice.SubtitleBuilder(video_script)
+    video_concat_mode = _video_concat_mode(params)
+
+    candidates, downloaded_videos, timelines = None, None, None
+    planned_duration = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        audio_future = executor.submit(
+            generate_audio, task_id, params, video_script, subtitle_builder.add
+        )
+        while not audio_future.done():
+            if subtitle_builder.spoken_share() >= estimate_share:
+                break
+            wait([audio_future], timeout=0.2)
+
+        if not audio_future.done():
+            # nothing to extrapolate from until the first words are spoken
+            planned_duration = subtitle_builder.estimate_duration() * (1 + margin)
+        if planned_duration > 0:
+            logger.info(
+                f"\n\n## audio is being generated, estimated duration: "
+                f"{planned_duration:.1f} seconds"
+            )
+            # the state of the task is only changed by the fetch made once
+            # the audio is ready
+            try:
+                candidates = material.search_materials(
+                    search_terms=video_terms,
+                    source=params.video_source,
+                    video_aspect=params.video_aspect,
+                    video_contact_mode=video_concat_mode,
+                    audio_duration=planned_duration * params.video_count,
+                    max_clip_duration=params.video_clip_duration,
+                )
+                downloaded_videos, timelines = material.download_timelines(
+                    task_id=task_id,
+                    search_terms=video_terms,
+                    video_contact_mode=video_concat_mode,
+                    audio_duration=planned_duration,
+                    max_clip_duration=params.video_clip_duration,
+                    video_count=params.video_count,
+                    candidates=candidates,
+                    pins=pins,
+                )
+            except Exception as e:
+                logger.warning(f"failed to fetch materials early: {str(e)}")
+                downloaded_videos, timelines = None, None
+        audio_file, audio_info, sub_maker = audio_future.result()
 
+    if not audio_file:
+        return None, None, None, None, None, None
 
-def generate_final_videos(
-        task_id, params, downloaded_videos, audio_file, subtitle_path
-):
-    final_video_paths = []
-    combined_video_paths = []
-    video_concat_mode = (
-        params.video_concat_mode if params.video_count == 1 else VideoConcatMode.random
-    )
+    if subtitle_builder.word_count != len(sub_maker.subs):
+        # a synthesis was retried after some words were passed on
+        subtitle_builder = voice.SubtitleBuilder(video_script)
+        for offset, sub in zip(sub_maker.offset, sub_maker.subs):
+            subtitle_builder.add(offset, sub)
 
-    _progress = 50
-    for i in range(params.video_count):
-        index = i + 1
-        combined_video_path = path.join(
-            utils.task_dir(task_id), f"combined-{index}.mp4"
+    if not downloaded_videos:
+        downloaded_videos, timelines = get_video_materials(
+            task_id, params, video_terms, audio_info["duration"], pins
         )
-        logger.info(f"\n\n## combining video: {index} => {combined_video_path}")
-        video.combine_videos(
-            combined_video_path=combined_video_path,
-            video_paths=downloaded_videos,
-            audio_file=audio_file,
-            video_aspect=params.video_aspect,
-            video_concat_mode=video_concat_mode,
+    elif planned_duration < audio_info["duration"]:
+        logger.info(
+            f"audio is longer than estimated: {audio_info['duration']} seconds, "
+            "topping up the materials"
+        )
+        downloaded_videos, timelines = material.extend_timelines(
+            task_id=task_id,
+            timelines=timelines,
+            candidates=candidates,
+            video_contact_mode=video_concat_mode,
+            audio_duration=audio_info["duration"],
             max_clip_duration=params.video_clip_duration,
-            threads=params.n_threads,
+            pins=pins,
         )
+    return (
+        audio_file,
+        audio_info,
+        sub_maker,
+        subtitle_builder,
+        downloaded_videos,
+        timelines,
+    )
+
 
-        _progress += 50 / params.video_count / 2
-        sm.state.update_task(task_id, progress=_progress)
+def _render_variant(
+    task_id,
+    index,
+    params,
+    downloaded_videos,
+    audio_file,
+    subtitle_path,
+    video_concat_mode,
+    shared_inputs,
+    report_progress,
+    spans=None,
+):
+    """
+    render one variant, return (final_video_path, combined_video_path),
+    combined_video_path is empty when the ffmpeg backend renders in one pass,
+    spans is the timeline planned while downloading the materials
+    """
+    final_video_path = path.join(utils.task_dir(task_id), f"final-{index}.mp4")
+    audio_duration = shared_inputs.get("audio_duration", 0)
+    mixed_audio_file = shared_inputs.get("mixed_audio_file", "")
+    ass_file = shared_inputs.get("ass_file", "")
+
+    if params.render_backend == const.RENDER_BACKEND_FFMPEG:
+        logger.info(f"\n\n## rendering video: {index} => {final_video_path}")
+        try:
+            if spans:
+                render_spans = planner.fit_spans(spans, audio_duration)
+            else:
+                render_spans = video.plan_clips(
+                    video_paths=downloaded_videos,
+                    audio_duration=audio_duration,
+                    video_concat_mode=video_concat_mode,
+                    max_clip_duration=params.video_clip_duration,
+                )
+            renderer.render_video(
+                spans=render_spans,
+                audio_path=mixed_audio_file or audio_file,
+                subtitle_path=subtitle_path,
+                output_file=final_video_path,
+                params=params,
+                audio_mixed=bool(mixed_audio_file),
+                ass_path=ass_file,
+            )
+            report_progress(index, 100)
+            return final_video_path, ""
+        except Exception as e:
+            logger.error(f"ffmpeg render failed, fallback to moviepy: {str(e)}")
+
+    combined_video_path = path.join(utils.task_dir(task_id), f"combined-{index}.mp4")
+    logger.info(f"\n\n## combining video: {index} => {combined_video_path}")
+    video.combine_videos(
+        combined_video_path=combined_video_path,
+        video_paths=downloaded_videos,
+        audio_file=audio_file,
+        video_aspect=params.video_aspect,
+        video_concat_mode=video_concat_mode,
+        max_clip_duration=params.video_clip_duration,
+        threads=params.n_threads,
+        spans=spans,
+        audio_duration=audio_duration,
+        workers=shared_inputs.get("combine_workers"),
+    )
+    report_progress(index, 50)
+
+    logger.info(f"\n\n## generating video: {index} => {final_video_path}")
+    subtitle_clips = None
+    if (
+        params.subtitle_renderer != const.SUBTITLE_RENDERER_LIBASS
+        and "get_subtitle_clips" in shared_inputs
+    ):
+        subtitle_clips = shared_inputs["get_subtitle_clips"]()
+    video.generate_video(
+        video_path=combined_video_path,
+        audio_path=mixed_audio_file or audio_file,
+        subtitle_path=subtitle_path,
+        output_file=final_video_path,
+        params=params,
+        subtitle_clips=subtitle_clips,
+        audio_mixed=bool(mixed_audio_file),
+        ass_path=ass_file,
+    )
+    report_progress(index, 100)
+    return final_video_path, combined_video_path
 
-        final_video_path = path.join(utils.task_dir(task_id), f"final-{index}.mp4")
 
-        logger.info(f"\n\n## generating video: {index} => {final_video_path}")
-        video.generate_video(
-            video_path=combined_video_path,
+def _prepare_shared_inputs(
+    task_id, params, audio_file, subtitle_path, audio_duration=0
+):
+    """
+    decode the inputs every variant uses (voice + bgm mix, subtitles) once
+    """
+    if not audio_duration:
+        audio_duration = ffmpeg.probe(audio_file).get("duration", 0)
+    shared_inputs = {"audio_duration": audio_duration}
+
+    # both the ffmpeg backend and the libass renderer burn the exported ass file
+    if subtitle_path and (
+        params.render_backend == const.RENDER_BACKEND_FFMPEG
+        or params.subtitle_renderer == const.SUBTITLE_RENDERER_LIBASS
+    ):
+        try:
+            shared_inputs["ass_file"] = subtitle_ass.create_ass_file(
+                subtitle_path, params
+            )
+        except Exception as e:
+            logger.warning(f"failed to create ass subtitle: {str(e)}")
+    if params.video_count <= 1:
+        return shared_inputs
+
+    mixed_audio_file = path.join(utils.task_dir(task_id), "audio-mixed.m4a")
+    try:
+        renderer.mix_audio(
             audio_path=audio_file,
-            subtitle_path=subtitle_path,
-            output_file=final_video_path,
+            output_file=mixed_audio_file,
             params=params,
+            duration=shared_inputs["audio_duration"],
         )
+        shared_inputs["mixed_audio_file"] = mixed_audio_file
+    except Exception as e:
+        logger.warning(f"failed to mix audio, each variant mixes its own: {str(e)}")
+
+    # subtitle clips are only needed by the moviepy path, build them on first use
+    lock = threading.Lock()
+    subtitle_clips = []
+
+    def get_subtitle_clips():
+        with lock:
+            if not subtitle_clips:
+                subtitle_clips.append(
+                    video.create_subtitle_clips(subtitle_path, params)
+                )
+        return subtitle_clips[0]
 
-        _progress += 50 / params.video_count / 2
-        sm.state.update_task(task_id, progress=_progress)
+    shared_inputs["get_subtitle_clips"] = get_subtitle_clips
+    return shared_inputs
 
-        final_video_paths.append(final_video_path)
-        combined_video_paths.append(combined_video_path)
 
+def generate_final_videos(
+    task_id,
+    params,
+    downloaded_videos,
+    audio_file,
+    subtitle_path,
+    timelines=None,
+    audio_duration=0,
+    memory=None,
+):
+    video_concat_mode = _video_concat_mode(params)
+    shared_inputs = _prepare_shared_inputs(
+        task_id, params, audio_file, subtitle_path, audio_duration
+    )
+
+    progress_lock = threading.Lock()
+    variant_progress = [0] * params.video_count
+
+    def report_progress(index, progress):
+        with progress_lock:
+            variant_progress[index - 1] = progress
+            _progress = 50 + 50 * sum(variant_progress) / 100 / params.video_count
+            sm.state.update_task(
+                task_id,
+                progress=_progress,
+                variants=list(variant_progress),
+                memory_peak_mb=memory.peak() if memory else {},
+            )
+
+    max_workers = config.app.get("max_parallel_variants", os.cpu_count() or 1)
+    max_workers = max(1, min(params.video_count, max_workers))
+    logger.info(f"rendering {params.video_count} videos with {max_workers} workers")
+    # the clip encoding processes are shared out between the variants
+    # rendered at the same time
+    shared_inputs["combine_workers"] = (
+        int(config.app.get("video_combine_workers", 0)) // max_workers
+    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _render_variant,
+                task_id,
+                i + 1,
+                params,
+                downloaded_videos,
+                audio_file,
+                subtitle_path,
+                video_concat_mode,
+                shared_inputs,
+                report_progress,
+                timelines[i] if timelines else None,
+            )
+            for i in range(params.video_count)
+        ]
+        results = [future.result() for future in futures]
+
+    final_video_paths = [final for final, _ in results]
+    combined_video_paths = [combined for _, combined in results if combined]
     return final_video_paths, combined_video_paths
 
 
 def start(task_id, params: VideoParams, stop_at: str = "video"):
+    # the memory used while the task runs, reported with its progress
+    memory = utils.MemoryMonitor()
+    memory.start()
+    # the downloaded videos are kept from the cache eviction until the videos
+    # are rendered
+    try:
+        with material_store.pinned() as pins:
+            return _start(task_id, params, stop_at, memory, pins)
+    finally:
+        memory.stop()
+
+
+def _start(
+    task_id,
+    params: VideoParams,
+    stop_at: str,
+    memory: utils.MemoryMonitor,
+    pins: set,
+):
     logger.info(f"start task: {task_id}, stop_at: {stop_at}")
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=5)
 
@@ -245,11 +558,32 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
 
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=20)
 
-    # 3. Generate audio
-    audio_file, audio_duration, sub_maker = generate_audio(task_id, params, video_script)
+    # 3. Generate audio, in pipelined mode the materials are fetched meanwhile
+    pipelined = (
+        config.app.get("pipeline_audio", False)
+        and params.video_source != "local"
+        and stop_at in ("materials", "video")
+    )
+    subtitle_builder = None
+    if pipelined:
+        (
+            audio_file,
+            audio_info,
+            sub_maker,
+            subtitle_builder,
+            downloaded_videos,
+            timelines,
+        ) = generate_audio_and_materials(
+            task_id, params, video_script, video_terms, pins
+        )
+    else:
+        audio_file, audio_info, sub_maker = generate_audio(
+            task_id, params, video_script
+        )
     if not audio_file:
         sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
         return
+    audio_duration = audio_info["duration"]
 
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=30)
 
@@ -259,11 +593,18 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
             state=const.TASK_STATE_COMPLETE,
             progress=100,
             audio_file=audio_file,
+            audio_analysis=audio_info,
         )
-        return {"audio_file": audio_file, "audio_duration": audio_duration}
+        return {
+            "audio_file": audio_file,
+            "audio_duration": audio_duration,
+            "audio_analysis": audio_info,
+        }
 
     # 4. Generate subtitle
-    subtitle_path = generate_subtitle(task_id, params, video_script, sub_maker, audio_file)
+    subtitle_path = generate_subtitle(
+        task_id, params, video_script, sub_maker, audio_file, subtitle_builder
+    )
 
     if stop_at == "subtitle":
         sm.state.update_task(
@@ -277,9 +618,10 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=40)
 
     # 5. Get video materials
-    downloaded_videos = get_video_materials(
-        task_id, params, video_terms, audio_duration
-    )
+    if not pipelined:
+        downloaded_videos, timelines = get_video_materials(
+            task_id, params, video_terms, audio_duration, pins
+        )
     if not downloaded_videos:
         sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
         return
@@ -297,7 +639,14 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
 
     # 6. Generate final videos
     final_video_paths, combined_video_paths = generate_final_videos(
-        task_id, params, downloaded_videos, audio_file, subtitle_path
+        task_id,
+        params,
+        downloaded_videos,
+        audio_file,
+        subtitle_path,
+        timelines,
+        audio_duration,
+        memory,
     )
 
     if not final_video_paths:
@@ -315,9 +664,12 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
         "terms": video_terms,
         "audio_file": audio_file,
         "audio_duration": audio_duration,
+        "audio_analysis": audio_info,
         "subtitle_path": subtitle_path,
         "materials": downloaded_videos,
+        "memory_peak_mb": memory.peak(),
     }
+    logger.info(f"memory peak of the task: {kwargs['memory_peak_mb']} MB")
     sm.state.update_task(
         task_id, state=const.TASK_STATE_COMPLETE, progress=100, **kwargs
     )
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from edge_tts import SubMaker
+from loguru import logger
+
+from app.config import config
+from app.utils import utils
+
+_gc_lock = threading.Lock()
+
+
+def is_enabled() -> bool:
+    return bool(config.app.get("enable_tts_cache", True))
+
+
+def _cache_dir() -> str:
+    return utils.storage_dir("cache_tts", create=True)
+
+
+def _max_size() -> int:
+    return int(config.app.get("tts_cache_max_size_mb", 500)) * 1024 * 1024
+
+
+@contextmanager
+def _connect():
+    """
+    a connection inside a transaction, committed and closed on exit
+    """
+    conn = sqlite3.connect(os.path.join(_cache_dir(), "index.db"), timeout=30)
+    try:
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tts ("
+                " key TEXT PRIMARY KEY,"
+                " size INTEGER NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            yield conn
+    finally:
+        conn.close()
+
+
+def cache_key(text: str, voice_name: str, voice_rate: float, provider: str) -> str:
+    # whitespace does not change the speech
+    text = " ".join(text.split())
+    payload = json.dumps([text, voice_name, f"{voice_rate:.2f}", provider])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _paths(key: str):
+    cache_dir = _cache_dir()
+    return os.path.join(cache_dir, f"{key}.mp3"), os.path.join(cache_dir, f"{key}.json")
+
+
+def get(key: str, voice_file: str) -> Optional[SubMaker]:
+    """
+    copy the cached audio to voice_file and return its word boundaries, None
+    when the speech is not cached
+    """
+    if not is_enabled():
+        return None
+
+    audio_path, subs_path = _paths(key)
+    try:
+        with _connect() as conn:
+            row = conn.execute("SELECT key FROM tts WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+            if not (os.path.isfile(audio_path) and os.path.isfile(subs_path)):
+                conn.execute("DELETE FROM tts WHERE key = ?", (key,))
+                return None
+            conn.execute(
+                "UPDATE tts SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+
+        with open(subs_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        sub_maker = SubMaker()
+        sub_maker.subs = data["subs"]
+        sub_maker.offset = [tuple(offset) for offset in data["offset"]]
+        shutil.copyfile(audio_path, voice_file)
+        logger.info(f"tts cache hit: {key}, output file: {voice_file}")
+        return sub_maker
+    except Exception as e:
+        logger.warning(f"failed to read tts cache: {str(e)}")
+        return None
+
+
+def put(key: str, voice_file: str, sub_maker: SubMaker):
+    """
+    store the audio and the word boundaries of a speech, then evict the least
+    recently used speeches above tts_cache_max_size_mb
+    """
+    if not is_enabled() or not sub_maker or not sub_maker.subs:
+        return
+
+    audio_path, subs_path = _paths(key)
+    # tasks caching the same speech at the same time write their own files
+    suffix = f".{utils.get_uuid(True)}.tmp"
+    try:
+        shutil.copyfile(voice_file, f"{audio_path}{suffix}")
+        os.replace(f"{audio_path}{suffix}", audio_path)
+        with open(f"{subs_path}{suffix}", "w", encoding="utf-8") as f:
+            json.dump({"subs": sub_maker.subs, "offset": sub_maker.offset}, f)
+        os.replace(f"{subs_path}{suffix}", subs_path)
+
+        size = os.path.getsize(audio_path) + os.path.getsize(subs_path)
+        with _connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO tts (key, size, last_access) VALUES (?, ?, ?)",
+                (key, size, time.time()),
+            )
+        gc()
+    except Exception as e:
+        logger.warning(f"failed to write tts cache: {str(e)}")
+        for file_path in (f"{audio_path}{suffix}", f"{subs_path}{suffix}"):
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+
+def gc():
+    """
+    delete the least recently used speeches until the cache fits in
+    tts_cache_max_size_mb, 0 keeps everything
+    """
+    max_size = _max_size()
+    if max_size <= 0:
+        return
+
+    with _gc_lock, _connect() as conn:
+        rows = conn.execute("SELECT key, size FROM tts ORDER BY last_access").fetchall()
+        total_size = sum(size for _, size in rows)
+        for key, size in rows:
+            if total_size <= max_size:
+                break
+            for file_path in _paths(key):
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+            conn.execute("DELETE FROM tts WHERE key = ?", (key,))
+            total_size -= size
+            logger.info(f"evicted tts: {key}")
@@ -0,0 +1,71 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from loguru import logger
+
+from app.config import config
+
+_service = None
+_lock = threading.Lock()
+
+
+class TTSService:
+    """
+    a long-lived asyncio event loop on a background thread that runs the
+    syntheses of every task, instead of an event loop per call. at most
+    concurrency syntheses (throttle) run at the same time across all tasks.
+    """
+
+    def __init__(self, concurrency: int = 0):
+        if not concurrency:
+            concurrency = config.app.get("tts_service_concurrency", 8)
+        self._concurrency = max(1, concurrency)
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                self._semaphore = asyncio.Semaphore(self._concurrency)
+                ready.set()
+                loop.run_forever()
+
+            thread = threading.Thread(target=run, name="tts-service", daemon=True)
+            thread.start()
+            ready.wait()
+            self._loop, self._thread = loop, thread
+            logger.info(f"tts service started, concurrency: {self._concurrency}")
+
+    def submit(self, coro) -> Future:
+        """
+        schedule a coroutine on the service loop, the result is read from the
+        returned future by the calling thread
+        """
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def throttle(self, coro):
+        """
+        await coro once one of the synthesis slots is free, to be used on the
+        service loop
+        """
+        async with self._semaphore:
+            return await coro
+
+
+def get_service() -> TTSService:
+    global _service
+    if _service is None:
+        with _lock:
+            if _service is None:
+                _service = TTSService()
+    return _service
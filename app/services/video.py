@@ -1,16 +1,42 @@
 import glob
 import random
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from typing import List
 
 from loguru import logger
 from moviepy.editor import *
-from moviepy.video.tools.subtitles import SubtitlesClip
-from PIL import ImageFont
+from moviepy.video.tools.subtitles import file_to_subtitles
+from PIL import Image
 
+from app.config import config
 from app.models import const
-from app.models.schema import MaterialInfo, VideoAspect, VideoConcatMode, VideoParams
+from app.models.schema import (
+    ClipSpan,
+    MaterialInfo,
+    VideoAspect,
+    VideoConcatMode,
+    VideoParams,
+)
+from app.services import (
+    clip_cache,
+    clip_pool,
+    ffmpeg,
+    layout,
+    motion,
+    planner,
+    subtitle_ass,
+    subtitle_sprite,
+)
 from app.utils import utils
 
+# encoding parameters of the combined video, clips that already match them
+# can be concatenated without being decoded and re-encoded
+_TARGET_CODEC = "h264"
+_TARGET_PIX_FMT = "yuv420p"
+_TARGET_FPS = 30
+
 
 def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
     if not bgm_type:
@@ -28,6 +54,229 @@ def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
     return ""
 
 
+def plan_clips(
+    video_paths: List[str],
+    audio_duration: float,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    max_clip_duration: int = 5,
+) -> List[ClipSpan]:
+    """
+    decide which part of which video is used at which position of the timeline,
+    shared by all render backends so that they pick the same footage
+    """
+    sources = [
+        (video_path, ffmpeg.probe(video_path).get("duration", 0))
+        for video_path in video_paths
+    ]
+    return planner.plan_spans(
+        sources, audio_duration, video_concat_mode, max_clip_duration
+    )
+
+
+def _stream_copy_clips(
+    spans: List[ClipSpan],
+    combined_video_path: str,
+    video_width: int,
+    video_height: int,
+    duration: float,
+) -> bool:
+    """
+    fast path of combine_videos: when every clip already has the target codec,
+    resolution, fps and pixel format, cut them without re-encoding and join them
+    with the concat demuxer, the output lasts duration seconds
+    """
+    if not spans:
+        return False
+
+    infos = {}
+    for span in spans:
+        # stream copy can only start at a keyframe, the head of a file is
+        # always one, cutting in the middle would shift the timeline
+        if span.start > 0:
+            return False
+        if span.path not in infos:
+            infos[span.path] = ffmpeg.probe(span.path)
+        info = infos[span.path]
+        if (
+            info.get("codec") != _TARGET_CODEC
+            or info.get("pix_fmt") != _TARGET_PIX_FMT
+            or info.get("width") != video_width
+            or info.get("height") != video_height
+            or abs(info.get("fps", 0) - _TARGET_FPS) > 0.01
+        ):
+            return False
+
+    # a copied segment ends on a packet boundary, segments cut before the next
+    # keyframe run longer than planned and shift every later clip. the last
+    # one is cut by the duration of the output.
+    half_frame = 0.5 / _TARGET_FPS
+    keyframes = {}
+    for span in spans[:-1]:
+        if span.end >= infos[span.path]["duration"] - half_frame:
+            continue
+        if span.path not in keyframes:
+            try:
+                keyframes[span.path] = ffmpeg.keyframes(span.path)
+            except Exception as e:
+                logger.warning(f"failed to read keyframes: {span.path} => {str(e)}")
+                return False
+        if not any(abs(t - span.end) < half_frame for t in keyframes[span.path]):
+            return False
+
+    logger.info(f"all {len(spans)} clips match the target format, using stream copy")
+    segment_dir = f"{os.path.splitext(combined_video_path)[0]}-segments"
+    os.makedirs(segment_dir, exist_ok=True)
+    segment_paths = []
+    try:
+        for i, span in enumerate(spans):
+            segment_path = os.path.join(segment_dir, f"segment-{i:04d}.mp4")
+            ffmpeg.run(
+                [
+                    "-loglevel",
+                    "error",
+                    "-i",
+                    span.path,
+                    "-t",
+                    f"{span.duration:.3f}",
+                    "-map",
+                    "0:v:0",
+                    "-c",
+                    "copy",
+                    "-an",
+                    segment_path,
+                ]
+            )
+            segment_paths.append(segment_path)
+        ffmpeg.concat(segment_paths, combined_video_path, duration)
+        # frames reordered after the cut (b-frames) are copied with the ones
+        # they are decoded before and make the video run long
+        combined_duration = ffmpeg.probe(combined_video_path)["duration"]
+        if combined_duration - duration > 1 / _TARGET_FPS:
+            logger.info(
+                f"stream copy lasts {combined_duration} seconds instead of {duration}, "
+                f"fallback to re-encoding"
+            )
+            return False
+        return True
+    except Exception as e:
+        logger.warning(f"stream copy failed, fallback to re-encoding: {str(e)}")
+        return False
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+
+def _resize_clip(clip, video_width: int, video_height: int):
+    # Not all videos are same size, so we need to resize them
+    clip_w, clip_h = clip.size
+    if clip_w != video_width or clip_h != video_height:
+        clip_ratio = clip.w / clip.h
+        video_ratio = video_width / video_height
+
+        if clip_ratio == video_ratio:
+            # 等比例缩放
+            clip = clip.resize((video_width, video_height))
+        else:
+            # 等比缩放视频
+            if clip_ratio > video_ratio:
+                # 按照目标宽度等比缩放
+                scale_factor = video_width / clip_w
+            else:
+                # 按照目标高度等比缩放
+                scale_factor = video_height / clip_h
+
+            new_width = int(clip_w * scale_factor)
+            new_height = int(clip_h * scale_factor)
+            clip_resized = clip.resize(newsize=(new_width, new_height))
+
+            background = ColorClip(size=(video_width, video_height), color=(0, 0, 0))
+            clip = CompositeVideoClip(
+                [
+                    background.set_duration(clip.duration),
+                    clip_resized.set_position("center"),
+                ]
+            )
+
+        logger.info(
+            f"resizing video to {video_width} x {video_height}, clip size: {clip_w} x {clip_h}"
+        )
+    return clip
+
+
+def _encode_clip(
+    span: ClipSpan,
+    segment_path: str,
+    video_width: int,
+    video_height: int,
+    max_clip_duration: int,
+) -> str:
+    """
+    worker of the parallel mode of combine_videos, every segment is written
+    with the same encoding parameters so they can be joined by stream copy
+    """
+    source_clip = VideoFileClip(span.path).without_audio()
+    clip = source_clip.subclip(span.start, span.end).set_fps(30)
+    clip = _resize_clip(clip, video_width, video_height)
+    if clip.duration > max_clip_duration:
+        clip = clip.subclip(0, max_clip_duration)
+    clip.write_videofile(
+        filename=segment_path,
+        fps=30,
+        codec="libx264",
+        preset="medium",
+        audio=False,
+        threads=1,
+        logger=None,
+    )
+    clip.close()
+    source_clip.close()
+    return segment_path
+
+
+def _encode_clips_in_parallel(
+    spans: List[ClipSpan],
+    combined_video_path: str,
+    video_width: int,
+    video_height: int,
+    max_clip_duration: int,
+    workers: int,
+) -> bool:
+    """
+    encode every clip in its own process, then join the segments losslessly
+    """
+    logger.info(f"encoding {len(spans)} clips with {workers} workers")
+    segment_dir = f"{os.path.splitext(combined_video_path)[0]}-segments"
+    os.makedirs(segment_dir, exist_ok=True)
+    segment_paths = [
+        os.path.join(segment_dir, f"segment-{i:04d}.mp4") for i in range(len(spans))
+    ]
+    try:
+        # forking a process running other threads (variants, tts service,
+        # logging) may leave the child stuck on a lock held at that time
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _encode_clip,
+                    span,
+                    segment_path,
+                    video_width,
+                    video_height,
+                    max_clip_duration,
+                )
+                for span, segment_path in zip(spans, segment_paths)
+            ]
+            for future in futures:
+                future.result()
+        ffmpeg.concat(segment_paths, combined_video_path)
+        return True
+    except Exception as e:
+        logger.warning(f"parallel encoding failed, fallback to one process: {str(e)}")
+        return False
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+
 def combine_videos(
     combined_video_path: str,
     video_paths: List[str],
@@ -36,190 +285,139 @@ def combine_videos(
     video_concat_mode: VideoConcatMode = VideoConcatMode.random,
     max_clip_duration: int = 5,
     threads: int = 2,
+    spans: List[ClipSpan] = None,
+    audio_duration: float = 0,
+    workers: int = None,
 ) -> str:
-    audio_clip = AudioFileClip(audio_file)
-    audio_duration = audio_clip.duration
+    """
+    spans: timeline planned before the materials were downloaded, planned
+    from video_paths when not given
+    audio_duration: duration of audio_file when already measured
+    workers: processes encoding the clips, video_combine_workers when not given
+    """
+    if not audio_duration:
+        audio_clip = AudioFileClip(audio_file)
+        audio_duration = audio_clip.duration
+        audio_clip.close()
     logger.info(f"max duration of audio: {audio_duration} seconds")
-    # Required duration of each clip
-    req_dur = audio_duration / len(video_paths)
-    req_dur = max_clip_duration
-    logger.info(f"each clip will be maximum {req_dur} seconds long")
-    output_dir = os.path.dirname(combined_video_path)
+    logger.info(f"each clip will be maximum {max_clip_duration} seconds long")
 
     aspect = VideoAspect(video_aspect)
     video_width, video_height = aspect.to_resolution()
 
-    clips = []
-    video_duration = 0
-
-    raw_clips = []
-    for video_path in video_paths:
-        clip = VideoFileClip(video_path).without_audio()
-        clip_duration = clip.duration
-        start_time = 0
-
-        while start_time < clip_duration:
-            end_time = min(start_time + max_clip_duration, clip_duration)
-            split_clip = clip.subclip(start_time, end_time)
-            raw_clips.append(split_clip)
-            # logger.info(f"splitting from {start_time:.2f} to {end_time:.2f}, clip duration {clip_duration:.2f}, split_clip duration {split_clip.duration:.2f}")
-            start_time = end_time
-            if video_concat_mode.value == VideoConcatMode.sequential.value:
-                break
-
-    # random video_paths order
-    if video_concat_mode.value == VideoConcatMode.random.value:
-        random.shuffle(raw_clips)
-
-    # Add downloaded clips over and over until the duration of the audio (max_duration) has been reached
-    while video_duration < audio_duration:
-        for clip in raw_clips:
-            # Check if clip is longer than the remaining audio
-            if (audio_duration - video_duration) < clip.duration:
-                clip = clip.subclip(0, (audio_duration - video_duration))
-            # Only shorten clips if the calculated clip length (req_dur) is shorter than the actual clip to prevent still image
-            elif req_dur < clip.duration:
-                clip = clip.subclip(0, req_dur)
-            clip = clip.set_fps(30)
-
-            # Not all videos are same size, so we need to resize them
-            clip_w, clip_h = clip.size
-            if clip_w != video_width or clip_h != video_height:
-                clip_ratio = clip.w / clip.h
-                video_ratio = video_width / video_height
-
-                if clip_ratio == video_ratio:
-                    # 等比例缩放
-                    clip = clip.resize((video_width, video_height))
-                else:
-                    # 等比缩放视频
-                    if clip_ratio > video_ratio:
-                        # 按照目标宽度等比缩放
-                        scale_factor = video_width / clip_w
-                    else:
-                        # 按照目标高度等比缩放
-                        scale_factor = video_height / clip_h
-
-                    new_width = int(clip_w * scale_factor)
-                    new_height = int(clip_h * scale_factor)
-                    clip_resized = clip.resize(newsize=(new_width, new_height))
-
-                    background = ColorClip(
-                        size=(video_width, video_height), color=(0, 0, 0)
-                    )
-                    clip = CompositeVideoClip(
-                        [
-                            background.set_duration(clip.duration),
-                            clip_resized.set_position("center"),
-                        ]
-                    )
-
-                logger.info(
-                    f"resizing video to {video_width} x {video_height}, clip size: {clip_w} x {clip_h}"
+    # normalized clips used by this render are not evicted until it is written
+    with clip_cache.pinned() as pins:
+        if spans:
+            spans = planner.fit_spans(spans, audio_duration)
+            if clip_cache.is_enabled():
+                spans = clip_cache.map_spans(spans, aspect, max_clip_duration, pins)
+        else:
+            if clip_cache.is_enabled():
+                # pre-scaled clips of max_clip_duration seconds, already matching the
+                # target format, so they are usually joined with stream copy below
+                video_paths = clip_cache.normalize_videos(
+                    video_paths=video_paths,
+                    video_aspect=aspect,
+                    max_clip_duration=max_clip_duration,
+                    first_only=video_concat_mode.value
+                    == VideoConcatMode.sequential.value,
+                    pins=pins,
                 )
 
+            spans = plan_clips(
+                video_paths=video_paths,
+                audio_duration=audio_duration,
+                video_concat_mode=video_concat_mode,
+                max_clip_duration=max_clip_duration,
+            )
+
+        return _combine_spans(
+            spans=spans,
+            combined_video_path=combined_video_path,
+            video_width=video_width,
+            video_height=video_height,
+            audio_duration=audio_duration,
+            max_clip_duration=max_clip_duration,
+            threads=threads,
+            workers=workers,
+        )
+
+
+def _combine_spans(
+    spans: List[ClipSpan],
+    combined_video_path: str,
+    video_width: int,
+    video_height: int,
+    audio_duration: float,
+    max_clip_duration: int,
+    threads: int,
+    workers: int = None,
+) -> str:
+    output_dir = os.path.dirname(combined_video_path)
+    if _stream_copy_clips(
+        spans, combined_video_path, video_width, video_height, audio_duration
+    ):
+        logger.success("completed")
+        return combined_video_path
+
+    if workers is None:
+        workers = int(config.app.get("video_combine_workers", 0))
+    workers = min(workers, len(spans))
+    if workers > 1 and _encode_clips_in_parallel(
+        spans=spans,
+        combined_video_path=combined_video_path,
+        video_width=video_width,
+        video_height=video_height,
+        max_clip_duration=max_clip_duration,
+        workers=workers,
+    ):
+        logger.success("completed")
+        return combined_video_path
+
+    # sources are opened right before their frames are needed and closed
+    # after their last span, so only a few ffmpeg readers run at a time
+    with clip_pool.ReaderPool(spans) as pool:
+        clips = []
+        for index, span in enumerate(spans):
+            clip = pool.clip(span, index, video_width, video_height).set_fps(30)
+
             if clip.duration > max_clip_duration:
                 clip = clip.subclip(0, max_clip_duration)
 
             clips.append(clip)
-            video_duration += clip.duration
 
-    video_clip = concatenate_videoclips(clips)
-    video_clip = video_clip.set_fps(30)
-    logger.info("writing")
-    # https://github.com/harry0703/MoneyPrinterTurbo/issues/111#issuecomment-2032354030
-    video_clip.write_videofile(
-        filename=combined_video_path,
-        threads=threads,
-        logger=None,
-        temp_audiofile_path=output_dir,
-        audio_codec="aac",
-        fps=30,
-    )
-    video_clip.close()
+        video_clip = concatenate_videoclips(clips)
+        video_clip = video_clip.set_fps(30)
+        logger.info("writing")
+        # https://github.com/harry0703/MoneyPrinterTurbo/issues/111#issuecomment-2032354030
+        video_clip.write_videofile(
+            filename=combined_video_path,
+            threads=threads,
+            logger=None,
+            temp_audiofile_path=output_dir,
+            audio_codec="aac",
+            fps=30,
+        )
+        video_clip.close()
     logger.success("completed")
     return combined_video_path
 
 
 def wrap_text(text, max_width, font="Arial", fontsize=60):
-    # 创建字体对象
-    font = ImageFont.truetype(font, fontsize)
-
-    def get_text_size(inner_text):
-        inner_text = inner_text.strip()
-        left, top, right, bottom = font.getbbox(inner_text)
-        return right - left, bottom - top
-
-    width, height = get_text_size(text)
-    if width <= max_width:
-        return text, height
-
-    # logger.warning(f"wrapping text, max_width: {max_width}, text_width: {width}, text: {text}")
-
-    processed = True
-
-    _wrapped_lines_ = []
-    words = text.split(" ")
-    _txt_ = ""
-    for word in words:
-        _before = _txt_
-        _txt_ += f"{word} "
-        _width, _height = get_text_size(_txt_)
-        if _width <= max_width:
-            continue
-        else:
-            if _txt_.strip() == word.strip():
-                processed = False
-                break
-            _wrapped_lines_.append(_before)
-            _txt_ = f"{word} "
-    _wrapped_lines_.append(_txt_)
-    if processed:
-        _wrapped_lines_ = [line.strip() for line in _wrapped_lines_]
-        result = "\n".join(_wrapped_lines_).strip()
-        height = len(_wrapped_lines_) * height
-        # logger.warning(f"wrapped text: {result}")
-        return result, height
-
-    _wrapped_lines_ = []
-    chars = list(text)
-    _txt_ = ""
-    for word in chars:
-        _txt_ += word
-        _width, _height = get_text_size(_txt_)
-        if _width <= max_width:
-            continue
-        else:
-            _wrapped_lines_.append(_txt_)
-            _txt_ = ""
-    _wrapped_lines_.append(_txt_)
-    result = "\n".join(_wrapped_lines_).strip()
-    height = len(_wrapped_lines_) * height
-    # logger.warning(f"wrapped text: {result}")
-    return result, height
+    return layout.wrap_text(text, max_width, font=font, fontsize=fontsize)
 
 
-def generate_video(
-    video_path: str,
-    audio_path: str,
-    subtitle_path: str,
-    output_file: str,
-    params: VideoParams,
-):
+def create_subtitle_clips(subtitle_path: str, params: VideoParams) -> list:
+    """
+    build the subtitle overlay clips, the sprites are static images so the
+    clips can be shared by all variants of a task
+    """
+    if not subtitle_path or not os.path.exists(subtitle_path):
+        return []
+
     aspect = VideoAspect(params.video_aspect)
     video_width, video_height = aspect.to_resolution()
 
-    logger.info(f"start, video size: {video_width} x {video_height}")
-    logger.info(f"  ① video: {video_path}")
-    logger.info(f"  ② audio: {audio_path}")
-    logger.info(f"  ③ subtitle: {subtitle_path}")
-    logger.info(f"  ④ output: {output_file}")
-
-    # https://github.com/harry0703/MoneyPrinterTurbo/issues/217
-    # PermissionError: [WinError 32] The process cannot access the file because it is being used by another process: 'final-1.mp4.tempTEMP_MPY_wvf_snd.mp3'
-    # write into the same directory as the output file
-    output_dir = os.path.dirname(output_file)
-
     font_path = ""
     if params.subtitle_enabled:
         if not params.font_name:
@@ -230,63 +428,116 @@ def generate_video(
 
         logger.info(f"using font: {font_path}")
 
-    def create_text_clip(subtitle_item):
+    def create_text_item(subtitle_item):
         phrase = subtitle_item[1]
         max_width = video_width * 0.9
         wrapped_txt, txt_height = wrap_text(
             phrase, max_width=max_width, font=font_path, fontsize=params.font_size
         )
-        _clip = TextClip(
+        rgb, mask = subtitle_sprite.render_sprite(
             wrapped_txt,
-            font=font_path,
-            fontsize=params.font_size,
+            font_path=font_path,
+            font_size=params.font_size,
             color=params.text_fore_color,
             bg_color=params.text_background_color,
             stroke_color=params.stroke_color,
             stroke_width=params.stroke_width,
-            print_cmd=False,
         )
-        duration = subtitle_item[0][1] - subtitle_item[0][0]
-        _clip = _clip.set_start(subtitle_item[0][0])
-        _clip = _clip.set_end(subtitle_item[0][1])
-        _clip = _clip.set_duration(duration)
+        h, w = mask.shape
+        x = (video_width - w) / 2
         if params.subtitle_position == "bottom":
-            _clip = _clip.set_position(("center", video_height * 0.95 - _clip.h))
+            y = video_height * 0.95 - h
         elif params.subtitle_position == "top":
-            _clip = _clip.set_position(("center", video_height * 0.05))
+            y = video_height * 0.05
         elif params.subtitle_position == "custom":
             # 确保字幕完全在屏幕内
             margin = 10  # 额外的边距，单位为像素
-            max_y = video_height - _clip.h - margin
+            max_y = video_height - h - margin
             min_y = margin
-            custom_y = (video_height - _clip.h) * (params.custom_position / 100)
-            custom_y = max(min_y, min(custom_y, max_y))  # 限制 y 值在有效范围内
-            _clip = _clip.set_position(("center", custom_y))
+            custom_y = (video_height - h) * (params.custom_position / 100)
+            y = max(min_y, min(custom_y, max_y))  # 限制 y 值在有效范围内
         else:  # center
-            _clip = _clip.set_position(("center", "center"))
-        return _clip
+            y = (video_height - h) / 2
+        start_time, end_time = subtitle_item[0]
+        return start_time, end_time, rgb, mask, (x, y)
+
+    subtitle_items = file_to_subtitles(subtitle_path, encoding="utf-8")
+    items = [create_text_item(item) for item in subtitle_items]
+    items.sort(key=lambda item: item[0])
+    if not items:
+        return []
+    # a single layer looking up the active line by time, instead of one
+    # ImageMagick rendered TextClip layer per line
+    duration = max(item[1] for item in items)
+    return [subtitle_sprite.create_overlay_clip(items, duration)]
+
+
+def generate_video(
+    video_path: str,
+    audio_path: str,
+    subtitle_path: str,
+    output_file: str,
+    params: VideoParams,
+    subtitle_clips: list = None,
+    audio_mixed: bool = False,
+    ass_path: str = "",
+):
+    """
+    subtitle_clips: overlay clips built once by create_subtitle_clips, built from
+    subtitle_path when not given
+    audio_mixed: audio_path already contains the voice and bgm at their volumes
+    ass_path: subtitle exported by subtitle_ass, used by the libass renderer
+    """
+    aspect = VideoAspect(params.video_aspect)
+    video_width, video_height = aspect.to_resolution()
+
+    logger.info(f"start, video size: {video_width} x {video_height}")
+    logger.info(f"  ① video: {video_path}")
+    logger.info(f"  ② audio: {audio_path}")
+    logger.info(f"  ③ subtitle: {subtitle_path}")
+    logger.info(f"  ④ output: {output_file}")
+
+    # https://github.com/harry0703/MoneyPrinterTurbo/issues/217
+    # PermissionError: [WinError 32] The process cannot access the file because it is being used by another process: 'final-1.mp4.tempTEMP_MPY_wvf_snd.mp3'
+    # write into the same directory as the output file
+    output_dir = os.path.dirname(output_file)
 
     video_clip = VideoFileClip(video_path)
-    audio_clip = AudioFileClip(audio_path).volumex(params.voice_volume)
-
-    if subtitle_path and os.path.exists(subtitle_path):
-        sub = SubtitlesClip(subtitles=subtitle_path, encoding="utf-8")
-        text_clips = []
-        for item in sub.subtitles:
-            clip = create_text_clip(subtitle_item=item)
-            text_clips.append(clip)
-        video_clip = CompositeVideoClip([video_clip, *text_clips])
-
-    bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
-    if bgm_file:
+
+    ffmpeg_params = None
+    if (
+        params.subtitle_renderer == const.SUBTITLE_RENDERER_LIBASS
+        and subtitle_path
+        and os.path.exists(subtitle_path)
+    ):
+        # burn the subtitles while encoding, no frame is composited in python
         try:
-            bgm_clip = (
-                AudioFileClip(bgm_file).volumex(params.bgm_volume).audio_fadeout(3)
-            )
-            bgm_clip = afx.audio_loop(bgm_clip, duration=video_clip.duration)
-            audio_clip = CompositeAudioClip([audio_clip, bgm_clip])
+            if not ass_path:
+                ass_path = subtitle_ass.create_ass_file(subtitle_path, params)
+            ffmpeg_params = ["-vf", subtitle_ass.burn_filter(ass_path)]
+            subtitle_clips = []
         except Exception as e:
-            logger.error(f"failed to add bgm: {str(e)}")
+            logger.error(f"failed to create ass subtitle: {str(e)}")
+
+    if subtitle_clips is None:
+        subtitle_clips = create_subtitle_clips(subtitle_path, params)
+    if subtitle_clips:
+        video_clip = CompositeVideoClip([video_clip, *subtitle_clips])
+
+    if audio_mixed:
+        audio_clip = AudioFileClip(audio_path)
+    else:
+        audio_clip = AudioFileClip(audio_path).volumex(params.voice_volume)
+        bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
+        if bgm_file:
+            try:
+                bgm_clip = (
+                    AudioFileClip(bgm_file).volumex(params.bgm_volume).audio_fadeout(3)
+                )
+                bgm_clip = afx.audio_loop(bgm_clip, duration=video_clip.duration)
+                audio_clip = CompositeAudioClip([audio_clip, bgm_clip])
+            except Exception as e:
+                logger.error(f"failed to add bgm: {str(e)}")
 
     video_clip = video_clip.set_audio(audio_clip)
     video_clip.write_videofile(
@@ -296,54 +547,45 @@ def generate_video(
         threads=params.n_threads or 2,
         logger=None,
         fps=30,
+        ffmpeg_params=ffmpeg_params,
     )
     video_clip.close()
     del video_clip
     logger.success("completed")
 
 
-def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
+def preprocess_video(
+    materials: List[MaterialInfo],
+    clip_duration=4,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+):
     for material in materials:
         if not material.url:
             continue
 
         ext = utils.parse_extension(material.url)
-        try:
-            clip = VideoFileClip(material.url)
-        except Exception:
-            clip = ImageClip(material.url)
+        if ext in const.FILE_TYPE_IMAGES:
+            # only the header is read to get the size
+            with Image.open(material.url) as image:
+                width, height = image.size
+        else:
+            info = ffmpeg.probe(material.url)
+            width, height = info["width"], info["height"]
 
-        width = clip.size[0]
-        height = clip.size[1]
         if width < 480 or height < 480:
             logger.warning(f"video is too small, width: {width}, height: {height}")
             continue
 
         if ext in const.FILE_TYPE_IMAGES:
             logger.info(f"processing image: {material.url}")
-            # 创建一个图片剪辑，并设置持续时间为3秒钟
-            clip = (
-                ImageClip(material.url)
-                .set_duration(clip_duration)
-                .set_position("center")
-            )
-            # 使用resize方法来添加缩放效果。这里使用了lambda函数来使得缩放效果随时间变化。
-            # 假设我们想要从原始大小逐渐放大到120%的大小。
-            # t代表当前时间，clip.duration为视频总时长，这里是3秒。
-            # 注意：1 表示100%的大小，所以1.2表示120%的大小
-            zoom_clip = clip.resize(
-                lambda t: 1 + (clip_duration * 0.03) * (t / clip.duration)
-            )
-
-            # 如果需要，可以创建一个包含缩放剪辑的复合视频剪辑
-            # （这在您想要在视频中添加其他元素时非常有用）
-            final_clip = CompositeVideoClip([zoom_clip])
-
-            # 输出视频
+            # 从原始大小逐渐放大，1 + clip_duration * 0.03 倍
             video_file = f"{material.url}.mp4"
-            final_clip.write_videofile(video_file, fps=30, logger=None)
-            final_clip.close()
-            del final_clip
+            motion.image_to_video(
+                material.url,
+                video_file,
+                video_aspect=video_aspect,
+                duration=clip_duration,
+            )
             material.url = video_file
             logger.success(f"completed: {video_file}")
     return materials
@@ -1,6 +1,7 @@
 import asyncio
 import os
 import re
+import threading
 from datetime import datetime
 from xml.sax.saxutils import unescape
 from edge_tts.submaker import mktimestamp
@@ -10,1007 +11,16 @@ import edge_tts
 from moviepy.video.tools import subtitles
 
 from app.config import config
+from app.models import const
+from app.services import tts_cache, tts_service, voice_catalog
 from app.utils import utils
 
 
 def get_all_azure_voices(filter_locals=None) -> list[str]:
     if filter_locals is None:
         filter_locals = ["zh-CN", "en-US", "zh-HK", "zh-TW", "vi-VN"]
-    voices_str = """
-Name: af-ZA-AdriNeural
-Gender: Female
-
-Name: af-ZA-WillemNeural
-Gender: Male
-
-Name: am-ET-AmehaNeural
-Gender: Male
-
-Name: am-ET-MekdesNeural
-Gender: Female
-
-Name: ar-AE-FatimaNeural
-Gender: Female
-
-Name: ar-AE-HamdanNeural
-Gender: Male
-
-Name: ar-BH-AliNeural
-Gender: Male
-
-Name: ar-BH-LailaNeural
-Gender: Female
-
-Name: ar-DZ-AminaNeural
-Gender: Female
-
-Name: ar-DZ-IsmaelNeural
-Gender: Male
-
-Name: ar-EG-SalmaNeural
-Gender: Female
-
-Name: ar-EG-ShakirNeural
-Gender: Male
-
-Name: ar-IQ-BasselNeural
-Gender: Male
-
-Name: ar-IQ-RanaNeural
-Gender: Female
-
-Name: ar-JO-SanaNeural
-Gender: Female
-
-Name: ar-JO-TaimNeural
-Gender: Male
-
-Name: ar-KW-FahedNeural
-Gender: Male
-
-Name: ar-KW-NouraNeural
-Gender: Female
-
-Name: ar-LB-LaylaNeural
-Gender: Female
-
-Name: ar-LB-RamiNeural
-Gender: Male
-
-Name: ar-LY-ImanNeural
-Gender: Female
-
-Name: ar-LY-OmarNeural
-Gender: Male
-
-Name: ar-MA-JamalNeural
-Gender: Male
-
-Name: ar-MA-MounaNeural
-Gender: Female
-
-Name: ar-OM-AbdullahNeural
-Gender: Male
-
-Name: ar-OM-AyshaNeural
-Gender: Female
-
-Name: ar-QA-AmalNeural
-Gender: Female
-
-Name: ar-QA-MoazNeural
-Gender: Male
-
-Name: ar-SA-HamedNeural
-Gender: Male
-
-Name: ar-SA-ZariyahNeural
-Gender: Female
-
-Name: ar-SY-AmanyNeural
-Gender: Female
-
-Name: ar-SY-LaithNeural
-Gender: Male
-
-Name: ar-TN-HediNeural
-Gender: Male
-
-Name: ar-TN-ReemNeural
-Gender: Female
-
-Name: ar-YE-MaryamNeural
-Gender: Female
-
-Name: ar-YE-SalehNeural
-Gender: Male
-
-Name: az-AZ-BabekNeural
-Gender: Male
-
-Name: az-AZ-BanuNeural
-Gender: Female
-
-Name: bg-BG-BorislavNeural
-Gender: Male
-
-Name: bg-BG-KalinaNeural
-Gender: Female
-
-Name: bn-BD-NabanitaNeural
-Gender: Female
-
-Name: bn-BD-PradeepNeural
-Gender: Male
-
-Name: bn-IN-BashkarNeural
-Gender: Male
-
-Name: bn-IN-TanishaaNeural
-Gender: Female
-
-Name: bs-BA-GoranNeural
-Gender: Male
-
-Name: bs-BA-VesnaNeural
-Gender: Female
-
-Name: ca-ES-EnricNeural
-Gender: Male
-
-Name: ca-ES-JoanaNeural
-Gender: Female
-
-Name: cs-CZ-AntoninNeural
-Gender: Male
-
-Name: cs-CZ-VlastaNeural
-Gender: Female
-
-Name: cy-GB-AledNeural
-Gender: Male
-
-Name: cy-GB-NiaNeural
-Gender: Female
-
-Name: da-DK-ChristelNeural
-Gender: Female
-
-Name: da-DK-JeppeNeural
-Gender: Male
-
-Name: de-AT-IngridNeural
-Gender: Female
-
-Name: de-AT-JonasNeural
-Gender: Male
-
-Name: de-CH-JanNeural
-Gender: Male
-
-Name: de-CH-LeniNeural
-Gender: Female
-
-Name: de-DE-AmalaNeural
-Gender: Female
-
-Name: de-DE-ConradNeural
-Gender: Male
-
-Name: de-DE-FlorianMultilingualNeural
-Gender: Male
-
-Name: de-DE-KatjaNeural
-Gender: Female
-
-Name: de-DE-KillianNeural
-Gender: Male
-
-Name: de-DE-SeraphinaMultilingualNeural
-Gender: Female
-
-Name: el-GR-AthinaNeural
-Gender: Female
-
-Name: el-GR-NestorasNeural
-Gender: Male
-
-Name: en-AU-NatashaNeural
-Gender: Female
-
-Name: en-AU-WilliamNeural
-Gender: Male
-
-Name: en-CA-ClaraNeural
-Gender: Female
-
-Name: en-CA-LiamNeural
-Gender: Male
-
-Name: en-GB-LibbyNeural
-Gender: Female
-
-Name: en-GB-MaisieNeural
-Gender: Female
-
-Name: en-GB-RyanNeural
-Gender: Male
-
-Name: en-GB-SoniaNeural
-Gender: Female
-
-Name: en-GB-ThomasNeural
-Gender: Male
-
-Name: en-HK-SamNeural
-Gender: Male
-
-Name: en-HK-YanNeural
-Gender: Female
-
-Name: en-IE-ConnorNeural
-Gender: Male
-
-Name: en-IE-EmilyNeural
-Gender: Female
-
-Name: en-IN-NeerjaExpressiveNeural
-Gender: Female
-
-Name: en-IN-NeerjaNeural
-Gender: Female
-
-Name: en-IN-PrabhatNeural
-Gender: Male
-
-Name: en-KE-AsiliaNeural
-Gender: Female
-
-Name: en-KE-ChilembaNeural
-Gender: Male
-
-Name: en-NG-AbeoNeural
-Gender: Male
-
-Name: en-NG-EzinneNeural
-Gender: Female
-
-Name: en-NZ-MitchellNeural
-Gender: Male
-
-Name: en-NZ-MollyNeural
-Gender: Female
-
-Name: en-PH-JamesNeural
-Gender: Male
-
-Name: en-PH-RosaNeural
-Gender: Female
-
-Name: en-SG-LunaNeural
-Gender: Female
-
-Name: en-SG-WayneNeural
-Gender: Male
-
-Name: en-TZ-ElimuNeural
-Gender: Male
-
-Name: en-TZ-ImaniNeural
-Gender: Female
-
-Name: en-US-AnaNeural
-Gender: Female
-
-Name: en-US-AndrewNeural
-Gender: Male
-
-Name: en-US-AriaNeural
-Gender: Female
-
-Name: en-US-AvaNeural
-Gender: Female
-
-Name: en-US-BrianNeural
-Gender: Male
-
-Name: en-US-ChristopherNeural
-Gender: Male
-
-Name: en-US-EmmaNeural
-Gender: Female
-
-Name: en-US-EricNeural
-Gender: Male
-
-Name: en-US-GuyNeural
-Gender: Male
-
-Name: en-US-JennyNeural
-Gender: Female
-
-Name: en-US-MichelleNeural
-Gender: Female
-
-Name: en-US-RogerNeural
-Gender: Male
-
-Name: en-US-SteffanNeural
-Gender: Male
-
-Name: en-ZA-LeahNeural
-Gender: Female
-
-Name: en-ZA-LukeNeural
-Gender: Male
-
-Name: es-AR-ElenaNeural
-Gender: Female
-
-Name: es-AR-TomasNeural
-Gender: Male
-
-Name: es-BO-MarceloNeural
-Gender: Male
-
-Name: es-BO-SofiaNeural
-Gender: Female
-
-Name: es-CL-CatalinaNeural
-Gender: Female
-
-Name: es-CL-LorenzoNeural
-Gender: Male
-
-Name: es-CO-GonzaloNeural
-Gender: Male
-
-Name: es-CO-SalomeNeural
-Gender: Female
-
-Name: es-CR-JuanNeural
-Gender: Male
-
-Name: es-CR-MariaNeural
-Gender: Female
-
-Name: es-CU-BelkysNeural
-Gender: Female
-
-Name: es-CU-ManuelNeural
-Gender: Male
-
-Name: es-DO-EmilioNeural
-Gender: Male
-
-Name: es-DO-RamonaNeural
-Gender: Female
-
-Name: es-EC-AndreaNeural
-Gender: Female
-
-Name: es-EC-LuisNeural
-Gender: Male
-
-Name: es-ES-AlvaroNeural
-Gender: Male
-
-Name: es-ES-ElviraNeural
-Gender: Female
-
-Name: es-ES-XimenaNeural
-Gender: Female
-
-Name: es-GQ-JavierNeural
-Gender: Male
-
-Name: es-GQ-TeresaNeural
-Gender: Female
-
-Name: es-GT-AndresNeural
-Gender: Male
-
-Name: es-GT-MartaNeural
-Gender: Female
-
-Name: es-HN-CarlosNeural
-Gender: Male
-
-Name: es-HN-KarlaNeural
-Gender: Female
-
-Name: es-MX-DaliaNeural
-Gender: Female
-
-Name: es-MX-JorgeNeural
-Gender: Male
-
-Name: es-NI-FedericoNeural
-Gender: Male
-
-Name: es-NI-YolandaNeural
-Gender: Female
-
-Name: es-PA-MargaritaNeural
-Gender: Female
-
-Name: es-PA-RobertoNeural
-Gender: Male
-
-Name: es-PE-AlexNeural
-Gender: Male
-
-Name: es-PE-CamilaNeural
-Gender: Female
-
-Name: es-PR-KarinaNeural
-Gender: Female
-
-Name: es-PR-VictorNeural
-Gender: Male
-
-Name: es-PY-MarioNeural
-Gender: Male
-
-Name: es-PY-TaniaNeural
-Gender: Female
-
-Name: es-SV-LorenaNeural
-Gender: Female
-
-Name: es-SV-RodrigoNeural
-Gender: Male
-
-Name: es-US-AlonsoNeural
-Gender: Male
-
-Name: es-US-PalomaNeural
-Gender: Female
-
-Name: es-UY-MateoNeural
-Gender: Male
-
-Name: es-UY-ValentinaNeural
-Gender: Female
-
-Name: es-VE-PaolaNeural
-Gender: Female
-
-Name: es-VE-SebastianNeural
-Gender: Male
-
-Name: et-EE-AnuNeural
-Gender: Female
-
-Name: et-EE-KertNeural
-Gender: Male
-
-Name: fa-IR-DilaraNeural
-Gender: Female
-
-Name: fa-IR-FaridNeural
-Gender: Male
-
-Name: fi-FI-HarriNeural
-Gender: Male
-
-Name: fi-FI-NooraNeural
-Gender: Female
-
-Name: fil-PH-AngeloNeural
-Gender: Male
-
-Name: fil-PH-BlessicaNeural
-Gender: Female
-
-Name: fr-BE-CharlineNeural
-Gender: Female
-
-Name: fr-BE-GerardNeural
-Gender: Male
-
-Name: fr-CA-AntoineNeural
-Gender: Male
-
-Name: fr-CA-JeanNeural
-Gender: Male
-
-Name: fr-CA-SylvieNeural
-Gender: Female
-
-Name: fr-CA-ThierryNeural
-Gender: Male
-
-Name: fr-CH-ArianeNeural
-Gender: Female
-
-Name: fr-CH-FabriceNeural
-Gender: Male
-
-Name: fr-FR-DeniseNeural
-Gender: Female
-
-Name: fr-FR-EloiseNeural
-Gender: Female
-
-Name: fr-FR-HenriNeural
-Gender: Male
-
-Name: fr-FR-RemyMultilingualNeural
-Gender: Male
-
-Name: fr-FR-VivienneMultilingualNeural
-Gender: Female
-
-Name: ga-IE-ColmNeural
-Gender: Male
-
-Name: ga-IE-OrlaNeural
-Gender: Female
-
-Name: gl-ES-RoiNeural
-Gender: Male
-
-Name: gl-ES-SabelaNeural
-Gender: Female
-
-Name: gu-IN-DhwaniNeural
-Gender: Female
-
-Name: gu-IN-NiranjanNeural
-Gender: Male
-
-Name: he-IL-AvriNeural
-Gender: Male
-
-Name: he-IL-HilaNeural
-Gender: Female
-
-Name: hi-IN-MadhurNeural
-Gender: Male
-
-Name: hi-IN-SwaraNeural
-Gender: Female
-
-Name: hr-HR-GabrijelaNeural
-Gender: Female
-
-Name: hr-HR-SreckoNeural
-Gender: Male
-
-Name: hu-HU-NoemiNeural
-Gender: Female
-
-Name: hu-HU-TamasNeural
-Gender: Male
-
-Name: id-ID-ArdiNeural
-Gender: Male
-
-Name: id-ID-GadisNeural
-Gender: Female
-
-Name: is-IS-GudrunNeural
-Gender: Female
-
-Name: is-IS-GunnarNeural
-Gender: Male
-
-Name: it-IT-DiegoNeural
-Gender: Male
-
-Name: it-IT-ElsaNeural
-Gender: Female
-
-Name: it-IT-GiuseppeNeural
-Gender: Male
-
-Name: it-IT-IsabellaNeural
-Gender: Female
-
-Name: ja-JP-KeitaNeural
-Gender: Male
-
-Name: ja-JP-NanamiNeural
-Gender: Female
-
-Name: jv-ID-DimasNeural
-Gender: Male
-
-Name: jv-ID-SitiNeural
-Gender: Female
-
-Name: ka-GE-EkaNeural
-Gender: Female
-
-Name: ka-GE-GiorgiNeural
-Gender: Male
-
-Name: kk-KZ-AigulNeural
-Gender: Female
-
-Name: kk-KZ-DauletNeural
-Gender: Male
-
-Name: km-KH-PisethNeural
-Gender: Male
-
-Name: km-KH-SreymomNeural
-Gender: Female
-
-Name: kn-IN-GaganNeural
-Gender: Male
-
-Name: kn-IN-SapnaNeural
-Gender: Female
-
-Name: ko-KR-HyunsuNeural
-Gender: Male
-
-Name: ko-KR-InJoonNeural
-Gender: Male
-
-Name: ko-KR-SunHiNeural
-Gender: Female
-
-Name: lo-LA-ChanthavongNeural
-Gender: Male
-
-Name: lo-LA-KeomanyNeural
-Gender: Female
-
-Name: lt-LT-LeonasNeural
-Gender: Male
-
-Name: lt-LT-OnaNeural
-Gender: Female
-
-Name: lv-LV-EveritaNeural
-Gender: Female
-
-Name: lv-LV-NilsNeural
-Gender: Male
-
-Name: mk-MK-AleksandarNeural
-Gender: Male
-
-Name: mk-MK-MarijaNeural
-Gender: Female
-
-Name: ml-IN-MidhunNeural
-Gender: Male
-
-Name: ml-IN-SobhanaNeural
-Gender: Female
-
-Name: mn-MN-BataaNeural
-Gender: Male
-
-Name: mn-MN-YesuiNeural
-Gender: Female
-
-Name: mr-IN-AarohiNeural
-Gender: Female
-
-Name: mr-IN-ManoharNeural
-Gender: Male
-
-Name: ms-MY-OsmanNeural
-Gender: Male
-
-Name: ms-MY-YasminNeural
-Gender: Female
-
-Name: mt-MT-GraceNeural
-Gender: Female
-
-Name: mt-MT-JosephNeural
-Gender: Male
-
-Name: my-MM-NilarNeural
-Gender: Female
-
-Name: my-MM-ThihaNeural
-Gender: Male
-
-Name: nb-NO-FinnNeural
-Gender: Male
-
-Name: nb-NO-PernilleNeural
-Gender: Female
-
-Name: ne-NP-HemkalaNeural
-Gender: Female
-
-Name: ne-NP-SagarNeural
-Gender: Male
-
-Name: nl-BE-ArnaudNeural
-Gender: Male
-
-Name: nl-BE-DenaNeural
-Gender: Female
-
-Name: nl-NL-ColetteNeural
-Gender: Female
-
-Name: nl-NL-FennaNeural
-Gender: Female
-
-Name: nl-NL-MaartenNeural
-Gender: Male
-
-Name: pl-PL-MarekNeural
-Gender: Male
-
-Name: pl-PL-ZofiaNeural
-Gender: Female
-
-Name: ps-AF-GulNawazNeural
-Gender: Male
-
-Name: ps-AF-LatifaNeural
-Gender: Female
-
-Name: pt-BR-AntonioNeural
-Gender: Male
-
-Name: pt-BR-FranciscaNeural
-Gender: Female
-
-Name: pt-BR-ThalitaNeural
-Gender: Female
-
-Name: pt-PT-DuarteNeural
-Gender: Male
-
-Name: pt-PT-RaquelNeural
-Gender: Female
-
-Name: ro-RO-AlinaNeural
-Gender: Female
-
-Name: ro-RO-EmilNeural
-Gender: Male
-
-Name: ru-RU-DmitryNeural
-Gender: Male
-
-Name: ru-RU-SvetlanaNeural
-Gender: Female
-
-Name: si-LK-SameeraNeural
-Gender: Male
-
-Name: si-LK-ThiliniNeural
-Gender: Female
-
-Name: sk-SK-LukasNeural
-Gender: Male
-
-Name: sk-SK-ViktoriaNeural
-Gender: Female
-
-Name: sl-SI-PetraNeural
-Gender: Female
-
-Name: sl-SI-RokNeural
-Gender: Male
-
-Name: so-SO-MuuseNeural
-Gender: Male
-
-Name: so-SO-UbaxNeural
-Gender: Female
-
-Name: sq-AL-AnilaNeural
-Gender: Female
-
-Name: sq-AL-IlirNeural
-Gender: Male
-
-Name: sr-RS-NicholasNeural
-Gender: Male
-
-Name: sr-RS-SophieNeural
-Gender: Female
-
-Name: su-ID-JajangNeural
-Gender: Male
-
-Name: su-ID-TutiNeural
-Gender: Female
-
-Name: sv-SE-MattiasNeural
-Gender: Male
-
-Name: sv-SE-SofieNeural
-Gender: Female
-
-Name: sw-KE-RafikiNeural
-Gender: Male
-
-Name: sw-KE-ZuriNeural
-Gender: Female
-
-Name: sw-TZ-DaudiNeural
-Gender: Male
-
-Name: sw-TZ-RehemaNeural
-Gender: Female
-
-Name: ta-IN-PallaviNeural
-Gender: Female
-
-Name: ta-IN-ValluvarNeural
-Gender: Male
-
-Name: ta-LK-KumarNeural
-Gender: Male
-
-Name: ta-LK-SaranyaNeural
-Gender: Female
-
-Name: ta-MY-KaniNeural
-Gender: Female
-
-Name: ta-MY-SuryaNeural
-Gender: Male
-
-Name: ta-SG-AnbuNeural
-Gender: Male
-
-Name: ta-SG-VenbaNeural
-Gender: Female
-
-Name: te-IN-MohanNeural
-Gender: Male
-
-Name: te-IN-ShrutiNeural
-Gender: Female
-
-Name: th-TH-NiwatNeural
-Gender: Male
-
-Name: th-TH-PremwadeeNeural
-Gender: Female
-
-Name: tr-TR-AhmetNeural
-Gender: Male
-
-Name: tr-TR-EmelNeural
-Gender: Female
-
-Name: uk-UA-OstapNeural
-Gender: Male
-
-Name: uk-UA-PolinaNeural
-Gender: Female
-
-Name: ur-IN-GulNeural
-Gender: Female
-
-Name: ur-IN-SalmanNeural
-Gender: Male
-
-Name: ur-PK-AsadNeural
-Gender: Male
-
-Name: ur-PK-UzmaNeural
-Gender: Female
-
-Name: uz-UZ-MadinaNeural
-Gender: Female
-
-Name: uz-UZ-SardorNeural
-Gender: Male
-
-Name: vi-VN-HoaiMyNeural
-Gender: Female
-
-Name: vi-VN-NamMinhNeural
-Gender: Male
-
-Name: zh-CN-XiaoxiaoNeural
-Gender: Female
-
-Name: zh-CN-XiaoyiNeural
-Gender: Female
-
-Name: zh-CN-YunjianNeural
-Gender: Male
-
-Name: zh-CN-YunxiNeural
-Gender: Male
-
-Name: zh-CN-YunxiaNeural
-Gender: Male
-
-Name: zh-CN-YunyangNeural
-Gender: Male
-
-Name: zh-CN-liaoning-XiaobeiNeural
-Gender: Female
-
-Name: zh-CN-shaanxi-XiaoniNeural
-Gender: Female
-
-Name: zh-HK-HiuGaaiNeural
-Gender: Female
-
-Name: zh-HK-HiuMaanNeural
-Gender: Female
-
-Name: zh-HK-WanLungNeural
-Gender: Male
-
-Name: zh-TW-HsiaoChenNeural
-Gender: Female
-
-Name: zh-TW-HsiaoYuNeural
-Gender: Female
-
-Name: zh-TW-YunJheNeural
-Gender: Male
-
-Name: zu-ZA-ThandoNeural
-Gender: Female
-
-Name: zu-ZA-ThembaNeural
-Gender: Male
-
-
-Name: en-US-AvaMultilingualNeural-V2
-Gender: Female
-
-Name: en-US-AndrewMultilingualNeural-V2
-Gender: Male
-
-Name: en-US-EmmaMultilingualNeural-V2
-Gender: Female
-
-Name: en-US-BrianMultilingualNeural-V2
-Gender: Male
-
-Name: de-DE-FlorianMultilingualNeural-V2
-Gender: Male
-
-Name: de-DE-SeraphinaMultilingualNeural-V2
-Gender: Female
-
-Name: fr-FR-RemyMultilingualNeural-V2
-Gender: Male
-
-Name: fr-FR-VivienneMultilingualNeural-V2
-Gender: Female
-
-Name: zh-CN-XiaoxiaoMultilingualNeural-V2
-Gender: Female
-    """.strip()
-    voices = []
-    name = ""
-    for line in voices_str.split("\n"):
-        line = line.strip()
-        if not line:
-            continue
-        if line.startswith("Name: "):
-            name = line[6:].strip()
-        if line.startswith("Gender: "):
-            gender = line[8:].strip()
-            if name and gender:
-                # voices.append({
-                #     "name": name,
-                #     "gender": gender,
-                # })
-                if filter_locals:
-                    for filter_local in filter_locals:
-                        if name.lower().startswith(filter_local.lower()):
-                            voices.append(f"{name}-{gender}")
-                else:
-                    voices.append(f"{name}-{gender}")
-                name = ""
-    voices.sort()
-    return voices
+    voices = voice_catalog.get_catalog().filter(locales=filter_locals)
+    return [v.display_name for v in voices]
 
 
 def parse_voice_name(name: str):
@@ -1028,12 +38,47 @@ def is_azure_v2_voice(voice_name: str):
     return ""
 
 
+def _emit(on_word_boundary, offset: tuple, sub: str):
+    if on_word_boundary:
+        try:
+            on_word_boundary(offset, sub)
+        except Exception as e:
+            logger.warning(f"word boundary callback failed: {str(e)}")
+
+
 def tts(
-    text: str, voice_name: str, voice_rate: float, voice_file: str
+    text: str,
+    voice_name: str,
+    voice_rate: float,
+    voice_file: str,
+    on_word_boundary=None,
 ) -> [SubMaker, None]:
+    """
+    on_word_boundary((start, end), text) is called for every word as soon as
+    it is synthesized, offsets are in units of 100 nanoseconds
+    """
+    if is_azure_v2_voice(voice_name):
+        # azure v2 speaks at the default rate
+        key = tts_cache.cache_key(text, parse_voice_name(voice_name), 1.0, "azure_v2")
+    else:
+        key = tts_cache.cache_key(
+            text, parse_voice_name(voice_name), voice_rate, "edge"
+        )
+    sub_maker = tts_cache.get(key, voice_file)
+    if sub_maker:
+        for offset, sub in zip(sub_maker.offset, sub_maker.subs):
+            _emit(on_word_boundary, offset, sub)
+        return sub_maker
+
     if is_azure_v2_voice(voice_name):
-        return azure_tts_v2(text, voice_name, voice_file)
-    return azure_tts_v1(text, voice_name, voice_rate, voice_file)
+        sub_maker = azure_tts_v2(text, voice_name, voice_file, on_word_boundary)
+    else:
+        sub_maker = azure_tts_v1(
+            text, voice_name, voice_rate, voice_file, on_word_boundary
+        )
+    if sub_maker:
+        tts_cache.put(key, voice_file, sub_maker)
+    return sub_maker
 
 
 def convert_rate_to_percent(rate: float) -> str:
@@ -1047,11 +92,25 @@ def convert_rate_to_percent(rate: float) -> str:
 
 
 def azure_tts_v1(
-    text: str, voice_name: str, voice_rate: float, voice_file: str
+    text: str,
+    voice_name: str,
+    voice_rate: float,
+    voice_file: str,
+    on_word_boundary=None,
 ) -> [SubMaker, None]:
     voice_name = parse_voice_name(voice_name)
     text = text.strip()
     rate_str = convert_rate_to_percent(voice_rate)
+
+    # long scripts are synthesized in chunks, concurrently
+    chunk_size = config.app.get("tts_chunk_size", 400)
+    if chunk_size and len(text) > chunk_size:
+        chunks = _split_text(text, chunk_size)
+        if len(chunks) > 1:
+            return _chunked_tts(
+                chunks, voice_name, rate_str, voice_file, on_word_boundary
+            )
+
     for i in range(3):
         try:
             logger.info(f"start, voice name: {voice_name}, try: {i + 1}")
@@ -1067,9 +126,16 @@ def azure_tts_v1(
                             sub_maker.create_sub(
                                 (chunk["offset"], chunk["duration"]), chunk["text"]
                             )
+                            _emit(
+                                on_word_boundary,
+                                sub_maker.offset[-1],
+                                sub_maker.subs[-1],
+                            )
                 return sub_maker
 
-            sub_maker = asyncio.run(_do())
+            # runs on the shared tts event loop, not a new loop per call
+            service = tts_service.get_service()
+            sub_maker = service.submit(service.throttle(_do())).result()
             if not sub_maker or not sub_maker.subs:
                 logger.warning(f"failed, sub_maker is None or sub_maker.subs is None")
                 continue
@@ -1081,7 +147,185 @@ def azure_tts_v1(
     return None
 
 
-def azure_tts_v2(text: str, voice_name: str, voice_file: str) -> [SubMaker, None]:
+# chunks end with a sentence when possible
+_SENTENCE_ENDS = ".!?…。！？\n"
+# mp3 layer III bitrates (kbps) and sample rates by mpeg version
+_MP3_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_MP3_TAGS = (b"Xing", b"Info", b"VBRI")
+_MP3_SAMPLE_RATES = {
+    0b11: [44100, 48000, 32000],
+    0b10: [22050, 24000, 16000],
+    0b00: [11025, 12000, 8000],
+}
+
+
+def _split_text(text: str, chunk_size: int) -> list[str]:
+    """
+    split the text into chunks of about chunk_size characters, a chunk ends
+    after a line of utils.split_string_by_punctuations (with its punctuation)
+    so no subtitle line is cut, preferably at the end of a sentence
+    """
+    chunks = []
+    start = 0
+    pos = 0
+    for line in utils.split_string_by_punctuations(text):
+        index = text.find(line, pos)
+        if index < 0:
+            return [text]
+        pos = index + len(line)
+        end = pos
+        while end < len(text) and (
+            text[end] in "".join(const.PUNCTUATIONS) or text[end] in "\n\r"
+        ):
+            end += 1
+        sentence_end = any(c in _SENTENCE_ENDS for c in text[pos:end])
+        if end - start >= chunk_size * (1 if sentence_end else 2):
+            chunks.append(text[start:end].strip())
+            start = end
+    if text[start:].strip():
+        chunks.append(text[start:].strip())
+    return chunks
+
+
+def _mp3_duration(data: bytes) -> float:
+    """
+    duration in seconds of mp3 (layer III) data, counted frame by frame
+    """
+    samples = 0
+    sample_rate = 0
+    i = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        i = 10 + ((data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9])
+    while i + 4 <= len(data):
+        header = int.from_bytes(data[i : i + 4], "big")
+        version = (header >> 19) & 0b11
+        layer = (header >> 17) & 0b11
+        bitrate_index = (header >> 12) & 0b1111
+        rate_index = (header >> 10) & 0b11
+        if (
+            header >> 21 != 0x7FF
+            or version == 0b01
+            or layer != 0b01
+            or bitrate_index in (0, 15)
+            or rate_index == 3
+        ):
+            # not a frame header, look for the next one
+            i += 1
+            continue
+        bitrate = _MP3_BITRATES[1 if version == 0b11 else 2][bitrate_index] * 1000
+        sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+        padding = (header >> 9) & 1
+        if not samples and any(tag in data[i : i + 200] for tag in _MP3_TAGS):
+            # the xing / vbri header frame of an encoder holds no audio
+            samples -= 1152 if version == 0b11 else 576
+        if version == 0b11:
+            samples += 1152
+            i += 144 * bitrate // sample_rate + padding
+        else:
+            samples += 576
+            i += 72 * bitrate // sample_rate + padding
+    return samples / sample_rate if sample_rate else 0.0
+
+
+async def _synthesize(text: str, voice_name: str, rate_str: str):
+    """
+    audio bytes and word boundaries (offset, duration, text) of the text
+    """
+    communicate = edge_tts.Communicate(text, voice_name, rate=rate_str)
+    audio = bytearray()
+    boundaries = []
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio":
+            audio += chunk["data"]
+        elif chunk["type"] == "WordBoundary":
+            boundaries.append((chunk["offset"], chunk["duration"], chunk["text"]))
+    return bytes(audio), boundaries
+
+
+def _chunked_tts(
+    chunks: list[str],
+    voice_name: str,
+    rate_str: str,
+    voice_file: str,
+    on_word_boundary=None,
+) -> [SubMaker, None]:
+    """
+    synthesize the chunks concurrently on the tts service (at most
+    tts_concurrency at a time for this script), a failed chunk is retried
+    alone. the audio is joined in order and the word boundaries are shifted
+    by the duration of the chunks before them.
+    """
+    concurrency = max(1, config.app.get("tts_concurrency", 4))
+    logger.info(
+        f"start, voice name: {voice_name}, chunks: {len(chunks)}, concurrency: {concurrency}"
+    )
+
+    async def _do():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _chunk(index: int, chunk_text: str):
+            async with semaphore:
+                for i in range(3):
+                    try:
+                        audio, boundaries = await service.throttle(
+                            _synthesize(chunk_text, voice_name, rate_str)
+                        )
+                        if audio and boundaries:
+                            return audio, boundaries
+                        logger.warning(f"chunk {index + 1} has no word boundaries")
+                    except Exception as e:
+                        logger.warning(
+                            f"chunk {index + 1} failed, try: {i + 1}, error: {str(e)}"
+                        )
+                    if i < 2:
+                        await asyncio.sleep(i + 1)
+            raise RuntimeError(f"failed to synthesize chunk {index + 1}")
+
+        tasks = [
+            asyncio.ensure_future(_chunk(index, chunk))
+            for index, chunk in enumerate(chunks)
+        ]
+        # the words of a chunk are passed on once the chunks before it are
+        # done, their offsets are known then
+        audios = []
+        # word boundary offsets are in units of 100 nanoseconds
+        offset = 0
+        try:
+            for task in tasks:
+                audio, boundaries = await task
+                for word_offset, duration, word in boundaries:
+                    sub_maker.create_sub((offset + word_offset, duration), word)
+                    _emit(on_word_boundary, sub_maker.offset[-1], sub_maker.subs[-1])
+                offset += round(_mp3_duration(audio) * 10_000_000)
+                audios.append(audio)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            raise
+        return audios
+
+    sub_maker = SubMaker()
+    service = tts_service.get_service()
+    try:
+        audios = service.submit(_do()).result()
+    except Exception as e:
+        logger.error(f"failed, error: {str(e)}")
+        return None
+
+    with open(voice_file, "wb") as file:
+        for audio in audios:
+            file.write(audio)
+
+    logger.info(f"completed, output file: {voice_file}")
+    return sub_maker
+
+
+def azure_tts_v2(
+    text: str, voice_name: str, voice_file: str, on_word_boundary=None
+) -> [SubMaker, None]:
     voice_name = is_azure_v2_voice(voice_name)
     if not voice_name:
         logger.error(f"invalid voice name: {voice_name}")
@@ -1125,6 +369,7 @@ def azure_tts_v2(text: str, voice_name: str, voice_file: str) -> [SubMaker, None
                 offset = _format_duration_to_offset(evt.audio_offset)
                 sub_maker.subs.append(evt.text)
                 sub_maker.offset.append((offset, offset + duration))
+                _emit(on_word_boundary, sub_maker.offset[-1], evt.text)
 
             # Creates an instance of a speech config with specified subscription key and service region.
             speech_key = config.azure.get("speech_key", "")
@@ -1184,39 +429,44 @@ def _format_text(text: str) -> str:
     return text
 
 
-def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str):
+def _format_sub_item(
+    idx: int, start_time: float, end_time: float, sub_text: str
+) -> str:
     """
-    优化字幕文件
-    1. 将字幕文件按照标点符号分割成多行
-    2. 逐行匹配字幕文件中的文本
-    3. 生成新的字幕文件
+    1
+    00:00:00,000 --> 00:00:02,360
+    跑步是一项简单易行的运动
     """
+    start_t = mktimestamp(start_time).replace(".", ",")
+    end_t = mktimestamp(end_time).replace(".", ",")
+    return f"{idx}\n" f"{start_t} --> {end_t}\n" f"{sub_text}\n"
 
-    text = _format_text(text)
 
-    def formatter(idx: int, start_time: float, end_time: float, sub_text: str) -> str:
-        """
-        1
-        00:00:00,000 --> 00:00:02,360
-        跑步是一项简单易行的运动
-        """
-        start_t = mktimestamp(start_time).replace(".", ",")
-        end_t = mktimestamp(end_time).replace(".", ",")
-        return f"{idx}\n" f"{start_t} --> {end_t}\n" f"{sub_text}\n"
-
-    start_time = -1.0
-    sub_items = []
-    sub_index = 0
-
-    script_lines = utils.split_string_by_punctuations(text)
+class SubtitleBuilder:
+    """
+    build the subtitle lines while the word boundaries arrive: the words are
+    joined until they match the next line of the script. add() may be called
+    from another thread than the other methods.
+    """
 
-    def match_line(_sub_line: str, _sub_index: int):
-        if len(script_lines) <= _sub_index:
+    def __init__(self, text: str):
+        self.script_lines = utils.split_string_by_punctuations(_format_text(text))
+        self.sub_items = []
+        self.word_count = 0
+        self._sub_line = ""
+        self._start_time = -1.0
+        self._matched_end = 0
+        self._matched_chars = 0
+        self._total_chars = sum(len(line) for line in self.script_lines)
+        self._lock = threading.Lock()
+
+    def _match_line(self, _sub_line: str, _sub_index: int):
+        if len(self.script_lines) <= _sub_index:
             return ""
 
-        _line = script_lines[_sub_index]
+        _line = self.script_lines[_sub_index]
         if _sub_line == _line:
-            return script_lines[_sub_index].strip()
+            return self.script_lines[_sub_index].strip()
 
         _sub_line_ = re.sub(r"[^\w\s]", "", _sub_line)
         _line_ = re.sub(r"[^\w\s]", "", _line)
@@ -1230,30 +480,60 @@ def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str)
 
         return ""
 
-    sub_line = ""
-
-    try:
-        for _, (offset, sub) in enumerate(zip(sub_maker.offset, sub_maker.subs)):
+    def add(self, offset: tuple, sub: str):
+        with self._lock:
+            self.word_count += 1
             _start_time, end_time = offset
-            if start_time < 0:
-                start_time = _start_time
+            if self._start_time < 0:
+                self._start_time = _start_time
 
-            sub = unescape(sub)
-            sub_line += sub
-            sub_text = match_line(sub_line, sub_index)
+            self._sub_line += unescape(sub)
+            sub_index = len(self.sub_items)
+            sub_text = self._match_line(self._sub_line, sub_index)
             if sub_text:
-                sub_index += 1
-                line = formatter(
-                    idx=sub_index,
-                    start_time=start_time,
+                line = _format_sub_item(
+                    idx=sub_index + 1,
+                    start_time=self._start_time,
                     end_time=end_time,
                     sub_text=sub_text,
                 )
-                sub_items.append(line)
-                start_time = -1.0
-                sub_line = ""
+                self.sub_items.append(line)
+                self._matched_end = end_time
+                self._matched_chars += len(self.script_lines[sub_index])
+                self._start_time = -1.0
+                self._sub_line = ""
+
+    def spoken_share(self) -> float:
+        """
+        share of the script (in characters) already matched
+        """
+        with self._lock:
+            if not self._total_chars:
+                return 0.0
+            return self._matched_chars / self._total_chars
+
+    def estimate_duration(self) -> float:
+        """
+        duration in seconds of the whole speech extrapolated from the lines
+        matched so far, 0 before the first line
+        """
+        with self._lock:
+            if not self._matched_chars:
+                return 0.0
+            matched_duration = self._matched_end / 10000000
+            return matched_duration * self._total_chars / self._matched_chars
 
-        if len(sub_items) == len(script_lines):
+    def is_complete(self) -> bool:
+        with self._lock:
+            return len(self.sub_items) == len(self.script_lines)
+
+    def write(self, subtitle_file: str):
+        """
+        write the subtitle file when every line of the script was matched
+        """
+        with self._lock:
+            sub_items = list(self.sub_items)
+        if len(sub_items) == len(self.script_lines):
             with open(subtitle_file, "w", encoding="utf-8") as file:
                 file.write("\n".join(sub_items) + "\n")
             try:
@@ -1267,9 +547,22 @@ def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str)
                 os.remove(subtitle_file)
         else:
             logger.warning(
-                f"failed, sub_items len: {len(sub_items)}, script_lines len: {len(script_lines)}"
+                f"failed, sub_items len: {len(sub_items)}, script_lines len: {len(self.script_lines)}"
             )
 
+
+def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str):
+    """
+    优化字幕文件
+    1. 将字幕文件按照标点符号分割成多行
+    2. 逐行匹配字幕文件中的文本
+    3. 生成新的字幕文件
+    """
+    try:
+        builder = SubtitleBuilder(text)
+        for offset, sub in zip(sub_maker.offset, sub_maker.subs):
+            builder.add(offset, sub)
+        builder.write(subtitle_file)
     except Exception as e:
         logger.error(f"failed, error: {str(e)}")
 
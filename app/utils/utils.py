@@ -2,6 +2,7 @@ import locale
 import os
 import platform
 import threading
+from contextlib import contextmanager
 from typing import Any
 from loguru import logger
 import json
@@ -227,3 +228,147 @@ def load_locales(i18n_dir):
 
 def parse_extension(filename):
     return os.path.splitext(filename)[1].strip().lower().replace(".", "")
+
+
+def _proc_memory_mb() -> dict:
+    # resident pages of every process, by pid, with their parent pid
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    processes = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat", "r") as f:
+                # the command name in parentheses may contain spaces
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        processes[int(pid)] = (int(fields[1]), int(fields[21]) * page_size)
+
+    own_pid = os.getpid()
+    children = 0
+    pending = [own_pid]
+    while pending:
+        parent = pending.pop()
+        for pid, (ppid, rss) in processes.items():
+            if ppid == parent:
+                children += rss
+                pending.append(pid)
+    process = processes.get(own_pid, (0, 0))[1]
+    return {
+        "process": round(process / 1024 / 1024, 1),
+        "children": round(children / 1024 / 1024, 1),
+    }
+
+
+def current_memory_mb() -> dict:
+    """
+    the resident set size in MB of this process and of all its child
+    processes (ffmpeg) together, empty where it can not be read
+    """
+    if os.path.isdir("/proc/self"):
+        try:
+            return _proc_memory_mb()
+        except Exception as e:
+            logger.debug(f"failed to read memory usage from /proc: {str(e)}")
+
+    try:
+        import psutil
+    except ImportError:
+        return {}
+
+    process = psutil.Process()
+    children = 0
+    for child in process.children(recursive=True):
+        try:
+            children += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return {
+        "process": round(process.memory_info().rss / 1024 / 1024, 1),
+        "children": round(children / 1024 / 1024, 1),
+    }
+
+
+class MemoryMonitor:
+    """
+    samples current_memory_mb() on a background thread while a task runs.
+    the process is shared by concurrent tasks, its usage when the task
+    started is kept as the baseline of the task.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.baseline = {}
+        self._peak = {}
+
+    def _sample(self):
+        usage = current_memory_mb()
+        with self._lock:
+            for key, value in usage.items():
+                self._peak[key] = max(self._peak.get(key, 0), value)
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self._sample()
+
+    def start(self):
+        self.baseline = current_memory_mb()
+        self._peak = dict(self.baseline)
+        self._thread = threading.Thread(
+            target=self._run, name="memory-monitor", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._sample()
+
+    def peak(self) -> dict:
+        """
+        the highest usage in MB of the process and of its children since the
+        task started, and how much the process grew over its baseline
+        """
+        with self._lock:
+            peak = dict(self._peak)
+        if "process" in peak:
+            peak["increase"] = round(peak["process"] - self.baseline["process"], 1)
+        return peak
+
+
+class KeyLocks:
+    """
+    a lock per key (file, url), created on first use and dropped once no
+    thread holds or waits for it, so the keys seen by a long running worker
+    do not pile up
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key):
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                # [lock, number of threads holding or waiting for it]
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._locks)
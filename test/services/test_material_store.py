@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from app.services import ffmpeg, material_store
+
+
+class TestMaterialStore(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        patches = [
+            mock.patch.object(material_store, "_cache_dir", lambda: self.cache_dir),
+            # smaller than any video, gc deletes every file it can
+            mock.patch.object(material_store, "_max_size", lambda: 1),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _download(self, name: str, color: str) -> str:
+        file_path = os.path.join(self.cache_dir, name)
+        ffmpeg.run(
+            [
+                "-loglevel",
+                "error",
+                "-f",
+                "lavfi",
+                "-i",
+                f"color=c={color}:size=64x64:rate=30:duration=1",
+                "-c:v",
+                "libx264",
+                "-pix_fmt",
+                "yuv420p",
+                file_path,
+            ]
+        )
+        return file_path
+
+    def test_gc_keeps_pinned_files(self):
+        with material_store.pinned() as pins:
+            pinned = material_store.add(
+                "http://example.com/a.mp4",
+                "pexels",
+                self._download("a.mp4", "red"),
+                pins,
+            )
+            unpinned = material_store.add(
+                "http://example.com/b.mp4", "pexels", self._download("b.mp4", "blue")
+            )
+            material_store.gc()
+            self.assertTrue(os.path.isfile(pinned["path"]))
+            self.assertFalse(os.path.isfile(unpinned["path"]))
+            self.assertIsNotNone(
+                material_store.lookup("http://example.com/a.mp4", self.cache_dir)
+            )
+
+        material_store.gc()
+        self.assertFalse(os.path.isfile(pinned["path"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
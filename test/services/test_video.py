@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from app.config import config
+from app.models.schema import ClipSpan, VideoAspect
+from app.services import ffmpeg, video
+
+
+class TestCombineVideos(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.audio_duration = 6.37
+        self.audio_file = os.path.join(self.tmp_dir, "audio.mp3")
+        ffmpeg.run(
+            [
+                "-loglevel",
+                "error",
+                "-f",
+                "lavfi",
+                "-i",
+                "anullsrc=r=44100:cl=mono",
+                "-t",
+                str(self.audio_duration),
+                self.audio_file,
+            ]
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _source(self, name: str, duration: int, b_frames: int) -> str:
+        # already in the target format, a keyframe every second
+        file_path = os.path.join(self.tmp_dir, name)
+        ffmpeg.run(
+            [
+                "-loglevel",
+                "error",
+                "-f",
+                "lavfi",
+                "-i",
+                f"testsrc=size=1920x1080:rate=30:duration={duration}",
+                "-c:v",
+                "libx264",
+                "-preset",
+                "ultrafast",
+                "-bf",
+                str(b_frames),
+                "-g",
+                "30",
+                "-pix_fmt",
+                "yuv420p",
+                file_path,
+            ]
+        )
+        return file_path
+
+    def _combine(self, b_frames: int) -> float:
+        spans = [
+            ClipSpan(path=self._source(f"{i}.mp4", 4, b_frames), start=0, end=3)
+            for i in range(3)
+        ]
+        output_file = os.path.join(self.tmp_dir, "combined.mp4")
+        with mock.patch.dict(config.app, {"enable_clip_cache": False}):
+            video.combine_videos(
+                combined_video_path=output_file,
+                video_paths=[],
+                audio_file=self.audio_file,
+                video_aspect=VideoAspect.landscape,
+                spans=spans,
+                audio_duration=self.audio_duration,
+            )
+        return ffmpeg.probe(output_file)["duration"]
+
+    def test_stream_copy_duration(self):
+        duration = self._combine(b_frames=0)
+        self.assertLessEqual(abs(duration - self.audio_duration), 1 / 30)
+
+    def test_stream_copy_duration_with_b_frames(self):
+        duration = self._combine(b_frames=2)
+        self.assertLessEqual(abs(duration - self.audio_duration), 1 / 30)
+
+
+if __name__ == "__main__":
+    unittest.main()